@@ -0,0 +1,62 @@
+import time
+import argparse
+from ..crypto import crypto
+
+
+MESSAGE_SIZES = [16, 1024, 16384, 65536]
+ITERATIONS = 200
+
+
+def time_operation(operation, iterations):
+    operation()
+    start = time.perf_counter()
+    for i in range(iterations):
+        operation()
+    return (time.perf_counter() - start) / iterations
+
+
+def benchmark_auth(keypair, iterations):
+    username = "user0"
+    date_time = crypto.current_date_time()
+    signature = crypto.generate_auth_signature(keypair, username, date_time)
+    return [
+        ("auth sign", "-", time_operation(lambda: crypto.generate_auth_signature(keypair, username, date_time), iterations)),
+        ("auth verify", "-", time_operation(lambda: crypto.verify_auth_signature(keypair.public_key(), signature, username, date_time), iterations))
+    ]
+
+
+def benchmark_messages(sender_keypair, receiver_keypair, message_size, iterations):
+    peers = {"sender": sender_keypair.public_key()}
+    message = "a" * message_size
+    send_time = crypto.current_date_time()
+    envelope = crypto.encrypt_message_bytes(sender_keypair, receiver_keypair.public_key(), "sender", "receiver", send_time, message)
+    decrypted_object = crypto.decrypt_message_contents(receiver_keypair, envelope)
+    return [
+        ("encrypt", message_size, time_operation(lambda: crypto.encrypt_message_bytes(
+            sender_keypair, receiver_keypair.public_key(), "sender", "receiver", send_time, message), iterations)),
+        ("decrypt", message_size, time_operation(lambda: crypto.decrypt_message_contents(receiver_keypair, envelope), iterations)),
+        ("verify", message_size, time_operation(lambda: crypto.verify_message_contents(decrypted_object, peers), iterations))
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the cost of the individual signing, verification, encryption and decryption operations.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=MESSAGE_SIZES)
+    parser.add_argument("--iterations", type=int, default=ITERATIONS)
+    args = parser.parse_args()
+
+    sender_keypair = crypto.generate_keypair()
+    receiver_keypair = crypto.generate_keypair()
+
+    results = benchmark_auth(sender_keypair, args.iterations)
+    for message_size in args.sizes:
+        results += benchmark_messages(sender_keypair, receiver_keypair, message_size, args.iterations)
+
+    print("operation    size  microseconds/op")
+    for (operation, message_size, seconds) in results:
+        print(operation.ljust(11) + str(message_size).rjust(6) + "  " + format(seconds * 1000000, ".1f").rjust(15))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import tempfile
+import contextlib
+import argparse
+import httpx
+from ..crypto import crypto
+from .server_workers import find_free_port, start_server
+
+
+BACKENDS = ["memory", "file", "log", "sharded", "sqlite"]
+USERS = 50
+CONCURRENCY = 32
+DURATION = 10
+MESSAGE_SIZES = [256, 1024, 4096, 16384]
+OPERATION_MIX = {"register": 1, "find": 4, "send": 10, "pull": 5}
+ENVELOPE_OVERHEAD = 600
+KEYPAIRS = 4
+SIGNED_AUTH_SHARE = .1
+
+
+def read_process_memory(pid):
+    memory = {"rss_kb": None, "peak_rss_kb": None}
+    try:
+        with open("/proc/" + str(pid) + "/status", "r", encoding="utf-8") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    memory["rss_kb"] = int(line.split()[1])
+                elif line.startswith("VmHWM:"):
+                    memory["peak_rss_kb"] = int(line.split()[1])
+    except FileNotFoundError:
+        pass
+    return memory
+
+
+def percentile(sorted_values, fraction):
+    if len(sorted_values) == 0:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+def summarize(latencies, errors, duration):
+    endpoints = {}
+    for (operation, values) in latencies.items():
+        values.sort()
+        endpoints[operation] = {
+            "requests": len(values),
+            "errors": errors[operation],
+            "throughput": len(values) / duration,
+            "p50_ms": None if len(values) == 0 else percentile(values, .5) * 1000,
+            "p99_ms": None if len(values) == 0 else percentile(values, .99) * 1000
+        }
+    return endpoints
+
+
+class LoadGenerator():
+    def __init__(self, http_client, public_keys, users, message_sizes, signed_auth_share):
+        self.http_client = http_client
+        self.public_keys = public_keys
+        self.usernames = ["user" + str(i) for i in range(users)]
+        self.signed_auth_share = signed_auth_share
+        self.keypairs = {}
+        self.signing_locks = {}
+        self.sessions = {}
+        self.cursors = {}
+        self.registered = 0
+        self.payloads = [os.urandom(size + ENVELOPE_OVERHEAD) for size in message_sizes]
+        self.latencies = {operation: [] for operation in list(OPERATION_MIX) + ["ack"]}
+        self.latencies.update({operation + "_signed": [] for operation in ["send", "pull", "ack"]})
+        self.errors = {operation: 0 for operation in self.latencies}
+
+    async def setup(self, keypairs):
+        for (i, username) in enumerate(self.usernames):
+            keypair = keypairs[i % len(keypairs)]
+            await self.http_client.put("/v1/user/register", json={
+                "username": username,
+                "public_key": crypto.export_public_key(keypair.public_key()),
+                "time": crypto.current_date_time().isoformat()})
+            date_time = crypto.current_date_time()
+            r = await self.http_client.post("/v1/user/" + username + "/session", json={
+                "username": username,
+                "time": date_time.isoformat(),
+                "signature": crypto.generate_auth_signature(keypair, username, date_time)})
+            self.sessions[username] = r.json()["token"]
+            self.keypairs[username] = keypair
+            self.signing_locks[username] = asyncio.Lock()
+            self.cursors[username] = 0
+
+    # The server only accepts strictly increasing signed auth times per user, so signed requests for one user are serialized.
+    @contextlib.asynccontextmanager
+    async def auth(self, username):
+        if random.random() >= self.signed_auth_share:
+            yield {"username": username, "token": self.sessions[username]}
+            return
+        async with self.signing_locks[username]:
+            date_time = crypto.current_date_time()
+            yield {"username": username, "time": date_time.isoformat(),
+                   "signature": crypto.generate_auth_signature(self.keypairs[username], username, date_time)}
+
+    def auth_operation(self, operation, auth):
+        return operation if "token" in auth else operation + "_signed"
+
+    def auth_headers(self, auth):
+        if "token" in auth:
+            return {"X-Auth-Token": auth["token"]}
+        return {"X-Auth-Time": auth["time"], "X-Auth-Signature": auth["signature"]}
+
+    async def timed(self, operation, request, expected_status_code):
+        start = time.perf_counter()
+        r = await request
+        self.latencies[operation].append(time.perf_counter() - start)
+        if r.status_code != expected_status_code:
+            self.errors[operation] += 1
+        return r
+
+    async def register(self):
+        self.registered += 1
+        await self.timed("register", self.http_client.put("/v1/user/register", json={
+            "username": "new" + str(os.getpid()) + "-" + str(self.registered),
+            "public_key": random.choice(self.public_keys),
+            "time": crypto.current_date_time().isoformat()}), 204)
+
+    async def find(self):
+        await self.timed("find", self.http_client.get("/v1/user/" + random.choice(self.usernames)), 200)
+
+    async def send(self):
+        sender = random.choice(self.usernames)
+        async with self.auth(sender) as auth:
+            await self.timed(self.auth_operation("send", auth), self.http_client.put(
+                "/v1/user/" + sender + "/message/send-binary", params={"recipient": random.choice(self.usernames)},
+                content=random.choice(self.payloads),
+                headers={"Content-Type": "application/octet-stream", **self.auth_headers(auth)}), 204)
+
+    async def pull(self):
+        username = random.choice(self.usernames)
+        async with self.auth(username) as auth:
+            r = await self.timed(self.auth_operation("pull", auth), self.http_client.post(
+                "/v1/user/" + username + "/message/pull", params={"cursor": self.cursors[username], "limit": 100}, json=auth), 200)
+        if r.status_code == 200 and len(r.json()["messages"]) > 0:
+            self.cursors[username] = r.json()["cursor"]
+            async with self.auth(username) as auth:
+                await self.timed(self.auth_operation("ack", auth), self.http_client.post(
+                    "/v1/user/" + username + "/message/ack", json={"auth": auth, "cursor": self.cursors[username]}), 204)
+
+    async def run(self, concurrency, duration):
+        operations = [getattr(self, operation) for (operation, weight) in OPERATION_MIX.items() for i in range(weight)]
+        deadline = time.perf_counter() + duration
+
+        async def client():
+            while time.perf_counter() < deadline:
+                await random.choice(operations)()
+
+        start = time.perf_counter()
+        await asyncio.gather(*[client() for i in range(concurrency)])
+        return time.perf_counter() - start
+
+
+async def benchmark_backend(server_url, keypairs, args):
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=server_url, limits=limits, timeout=60) as http_client:
+        generator = LoadGenerator(http_client, [crypto.export_public_key(keypair.public_key()) for keypair in keypairs],
+                                  args.users, args.sizes, args.signed_auth_share)
+        await generator.setup(keypairs)
+        duration = await generator.run(args.concurrency, args.duration)
+        return summarize(generator.latencies, generator.errors, duration)
+
+
+def benchmark(backend, keypairs, args):
+    with tempfile.TemporaryDirectory() as storage_dir:
+        (process, server_url) = start_server({
+            "E2E_SERVER_STORAGE": backend,
+            "E2E_MAILBOX_MAX_MESSAGES": str(10 ** 9),
+            "E2E_MAILBOX_MAX_BYTES": str(10 ** 12)
+        }, find_free_port(), storage_dir)
+        try:
+            endpoints = asyncio.run(benchmark_backend(server_url, keypairs, args))
+            result = {"endpoints": endpoints, "throughput": sum(endpoint["throughput"] for endpoint in endpoints.values())}
+            result.update(read_process_memory(process.pid))
+            return result
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a register/find/send/pull load against the server for each storage backend and report JSON results.")
+    parser.add_argument("--backends", nargs="+", default=BACKENDS, choices=BACKENDS)
+    parser.add_argument("--users", type=int, default=USERS)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--duration", type=float, default=DURATION)
+    parser.add_argument("--sizes", type=int, nargs="+", default=MESSAGE_SIZES)
+    parser.add_argument("--signed-auth-share", type=float, default=SIGNED_AUTH_SHARE,
+                        help="Fraction of send, pull and ack requests authenticated with an RSA signature instead of a session token")
+    parser.add_argument("--output", help="File to write the JSON results to instead of stdout")
+    args = parser.parse_args()
+
+    keypairs = [crypto.generate_keypair() for i in range(KEYPAIRS)]
+    results = {
+        "config": {"users": args.users, "concurrency": args.concurrency, "duration": args.duration,
+                   "message_sizes": args.sizes, "operation_mix": OPERATION_MIX, "signed_auth_share": args.signed_auth_share},
+        "backends": {backend: benchmark(backend, keypairs, args) for backend in args.backends}
+    }
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
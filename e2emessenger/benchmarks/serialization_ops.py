@@ -0,0 +1,83 @@
+import io
+import os
+import time
+import argparse
+from ..crypto import crypto
+from ..serialization import serialization
+from ..server.dao import InMemoryServerDAO, write_stored_users, read_stored_users
+
+
+USERS = 1000
+MAILBOX_SIZES = [0, 10, 100]
+MESSAGE_SIZE = 1024
+ITERATIONS = 5
+
+
+def time_operation(operation, iterations):
+    operation()
+    start = time.perf_counter()
+    for i in range(iterations):
+        operation()
+    return (time.perf_counter() - start) / iterations
+
+
+def build_users(users, mailbox_size, message_size):
+    dao = InMemoryServerDAO()
+    public_key = crypto.export_public_key(crypto.generate_keypair().public_key())
+    for i in range(users):
+        username = "user" + str(i)
+        dao.create_user(username, public_key, crypto.current_date_time().isoformat())
+        dao.save_user_messages([(username, os.urandom(message_size)) for j in range(mailbox_size)])
+    return dao.users
+
+
+# The stores persist users through the module level serializer, so it is swapped for the backend being measured.
+def benchmark_store(serializer, users, iterations):
+    default_serializer = serialization.serializer
+    serialization.serializer = serializer
+    try:
+        contents = write_stored_users(users)
+        return [
+            ("store dump", len(contents), time_operation(lambda: write_stored_users(users), iterations)),
+            ("store load", len(contents), time_operation(lambda: read_stored_users(io.BytesIO(contents)), iterations))
+        ]
+    finally:
+        serialization.serializer = default_serializer
+
+
+def benchmark_envelope(serializer, message_size, iterations):
+    envelope = {"from": "sender", "to": "receiver", "time": crypto.current_date_time().isoformat(),
+                "message": "a" * message_size, "hash": "a" * 44, "signature": "a" * 344}
+    contents = serializer.dumps(envelope)
+    return [
+        ("envelope dump", len(contents), time_operation(lambda: serializer.dumps(envelope), iterations * 1000)),
+        ("envelope load", len(contents), time_operation(lambda: serializer.loads(contents), iterations * 1000))
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the available JSON backends on server stores with realistic mailbox sizes and on message envelopes.")
+    parser.add_argument("--backends", nargs="+", default=serialization.available_backends(), choices=serialization.available_backends())
+    parser.add_argument("--users", type=int, default=USERS)
+    parser.add_argument("--mailbox-sizes", type=int, nargs="+", default=MAILBOX_SIZES)
+    parser.add_argument("--message-size", type=int, default=MESSAGE_SIZE)
+    parser.add_argument("--iterations", type=int, default=ITERATIONS)
+    args = parser.parse_args()
+
+    stores = [(mailbox_size, build_users(args.users, mailbox_size, args.message_size)) for mailbox_size in args.mailbox_sizes]
+
+    print("backend  operation      mailbox       bytes  milliseconds/op")
+    for backend in args.backends:
+        serializer = serialization.create_serializer(backend)
+        results = []
+        for (mailbox_size, users) in stores:
+            results += [(operation, mailbox_size, size, seconds) for (operation, size, seconds) in benchmark_store(serializer, users, args.iterations)]
+        results += [(operation, "-", size, seconds) for (operation, size, seconds) in benchmark_envelope(serializer, args.message_size, args.iterations)]
+        for (operation, mailbox_size, size, seconds) in results:
+            print(backend.ljust(9) + operation.ljust(15) + str(mailbox_size).rjust(7) + str(size).rjust(12) + "  " +
+                  format(seconds * 1000, ".3f").rjust(15))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import os
+import sys
+import time
+import socket
+import tempfile
+import argparse
+import threading
+import subprocess
+from datetime import timedelta
+import requests
+from ..crypto import crypto
+
+
+CLIENT_THREADS = 16
+AUTHS_PER_CLIENT = 1000
+SERVER_START_TIMEOUT = 30
+DURATION = 5
+WORKER_COUNTS = [1, 2, 4, 8]
+
+
+def find_free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def start_server(environment_overrides, port, storage_dir):
+    environment = dict(os.environ)
+    environment.update(environment_overrides)
+    environment["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "e2emessenger.server.server:app", "--port", str(port), "--log-level", "warning"],
+                               cwd=storage_dir, env=environment)
+    server_url = "http://127.0.0.1:" + str(port)
+    deadline = time.perf_counter() + SERVER_START_TIMEOUT
+    while process.poll() is None and time.perf_counter() < deadline:
+        try:
+            if requests.get(server_url + "/v1/health", timeout=1).status_code == 200:
+                return (process, server_url)
+        except requests.RequestException:
+            pass
+        time.sleep(.1)
+    if process.poll() is None:
+        process.terminate()
+        process.wait()
+        raise RuntimeError("Server did not become healthy within " + str(SERVER_START_TIMEOUT) + " seconds")
+    raise RuntimeError("Server exited with code " + str(process.returncode) + " before becoming healthy")
+
+
+def register_users(server_url, users):
+    keypairs = {}
+    for i in range(users):
+        username = "user" + str(i)
+        keypairs[username] = crypto.generate_keypair()
+        requests.put(server_url + "/v1/user/register", json={
+            "username": username,
+            "public_key": crypto.export_public_key(keypairs[username].public_key()),
+            "time": crypto.current_date_time().isoformat()})
+    return keypairs
+
+
+def presign_auths(keypairs, count):
+    start = crypto.current_date_time()
+    auths = {}
+    for username, keypair in keypairs.items():
+        auths[username] = []
+        for i in range(count):
+            date_time = start + timedelta(microseconds=i + 1)
+            auths[username].append({
+                "username": username,
+                "time": date_time.isoformat(),
+                "signature": crypto.generate_auth_signature(keypair, username, date_time)})
+    return auths
+
+
+# Every client thread has its own user, so its presigned times reach the server in order and are never rejected as replays.
+def run_load(server_url, auths, duration):
+    usernames = list(auths)
+    completed = [0] * len(usernames)
+    failed = [0] * len(usernames)
+    deadline = time.perf_counter() + duration
+
+    def client(index):
+        session = requests.Session()
+        username = usernames[index]
+        for auth in auths[username]:
+            if time.perf_counter() >= deadline:
+                break
+            if session.post(server_url + "/v1/user/" + username + "/message/pull", json=auth).status_code == 200:
+                completed[index] += 1
+            else:
+                failed[index] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(len(usernames))]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (sum(completed) / (time.perf_counter() - start), sum(failed))
+
+
+def benchmark(worker_threads, client_threads, duration, auths_per_client):
+    with tempfile.TemporaryDirectory() as storage_dir:
+        (process, server_url) = start_server({"E2E_SERVER_THREADS": str(worker_threads)}, find_free_port(), storage_dir)
+        try:
+            keypairs = register_users(server_url, client_threads)
+            auths = presign_auths(keypairs, auths_per_client)
+            return run_load(server_url, auths, duration)
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure authenticated pull requests/sec against the server for different worker thread counts.")
+    parser.add_argument("--workers", type=int, nargs="+", default=WORKER_COUNTS)
+    parser.add_argument("--clients", type=int, default=CLIENT_THREADS)
+    parser.add_argument("--duration", type=float, default=DURATION)
+    parser.add_argument("--auths-per-client", type=int, default=AUTHS_PER_CLIENT)
+    args = parser.parse_args()
+
+    print("workers  requests/sec  errors")
+    for worker_threads in args.workers:
+        (requests_per_second, errors) = benchmark(worker_threads, args.clients, args.duration, args.auths_per_client)
+        print(str(worker_threads).rjust(7) + "  " + format(requests_per_second, ".1f").rjust(12) + "  " + str(errors).rjust(6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import asyncio
+from functools import partial
+from datetime import datetime, timedelta
+import httpx
+from ..crypto import crypto
+
+
+class AsyncClientServices():
+    REQUEST_TIMEOUT = 10
+    WAIT_TIMEOUT = 30
+    PULL_PAGE_SIZE = 100
+    MAX_CONNECTIONS = 100
+    USE_SESSIONS = True
+    SESSION_REFRESH_MARGIN = timedelta(seconds=30)
+
+    def __init__(self, server_url, username, keypair, http_client=None, executor=None, peers=None):
+        self.server_url = server_url
+        self.username = username
+        self.keypair = keypair
+        self.owns_http_client = http_client is None
+        self.http_client = http_client if http_client is not None else self.create_http_client()
+        self.executor = executor
+        self.peers = peers if peers is not None else {}
+        self.session_token = None
+        self.session_expires = datetime.min
+        self.session_lock = asyncio.Lock()
+
+    @classmethod
+    def create_http_client(cls):
+        return httpx.AsyncClient(timeout=cls.REQUEST_TIMEOUT,
+                                 limits=httpx.Limits(max_connections=cls.MAX_CONNECTIONS, max_keepalive_connections=cls.MAX_CONNECTIONS))
+
+    async def close(self):
+        if self.owns_http_client:
+            await self.http_client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def __run_crypto(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(function, *args))
+
+    async def register(self):
+        r = await self.http_client.put(self.server_url + "/v1/user/register", json={
+            "username": self.username,
+            "public_key": crypto.export_public_key(self.keypair.public_key()),
+            "time": crypto.current_date_time().isoformat()})
+        return r.status_code == 204
+
+    async def find_user(self, username):
+        r = await self.http_client.get(self.server_url + "/v1/user/" + username)
+        if r.status_code == 200:
+            self.peers[username] = await self.__run_crypto(crypto.import_public_key, r.json()["public_key"])
+            return True
+        else:
+            return False
+
+    async def __ensure_peers(self, usernames):
+        missing_peers = [username for username in set(usernames) if username not in self.peers]
+        found = await asyncio.gather(*[self.find_user(username) for username in missing_peers])
+        return all(found)
+
+    async def send_message(self, recipient, message):
+        if not await self.__ensure_peers([recipient]):
+            return False
+        encrypted_message = await self.__run_crypto(crypto.encrypt_message_bytes, self.keypair, self.peers[recipient],
+                                                    self.username, recipient, crypto.current_date_time(), message)
+        auth = await self.__generate_auth_object()
+        r = await self.http_client.put(self.server_url + "/v1/user/" + self.username + "/message/send-binary",
+                                       params={"recipient": recipient}, content=encrypted_message, headers={
+                                           "Content-Type": "application/octet-stream",
+                                           **self.__generate_auth_headers(auth)
+                                       })
+        return self.__check_response(r, 204)
+
+    async def send_messages(self, recipients, message):
+        if not await self.__ensure_peers(recipients):
+            return False
+        send_time = crypto.current_date_time()
+        encrypted_messages = await asyncio.gather(*[self.__run_crypto(crypto.encrypt_message, self.keypair, self.peers[recipient],
+                                                                      self.username, recipient, send_time, message)
+                                                    for recipient in recipients])
+        auth = await self.__generate_auth_object()
+        r = await self.http_client.put(self.server_url + "/v1/user/" + self.username + "/message/send-batch", json={
+            "auth": auth,
+            "messages": [{"recipient": recipient, "message": encrypted_message}
+                         for (recipient, encrypted_message) in zip(recipients, encrypted_messages)]
+        })
+        return self.__check_response(r, 204)
+
+    async def pull_messages(self):
+        return await self.__pull_remaining_pages(0)
+
+    async def wait_for_messages(self, timeout=WAIT_TIMEOUT):
+        auth = await self.__generate_auth_object()
+        r = await self.http_client.post(self.server_url + "/v1/user/" + self.username + "/message/wait",
+                                        params={"timeout": timeout, "cursor": 0, "limit": self.PULL_PAGE_SIZE},
+                                        json=auth, timeout=timeout + self.REQUEST_TIMEOUT)
+        if not self.__check_response(r, 200):
+            return []
+        decrypted_messages = await self.__decrypt_messages(r.json()["messages"])
+        if len(r.json()["messages"]) < self.PULL_PAGE_SIZE:
+            if len(decrypted_messages) > 0:
+                await self.__ack_messages(r.json()["cursor"])
+            return decrypted_messages
+        return decrypted_messages + await self.__pull_remaining_pages(r.json()["cursor"])
+
+    async def __pull_remaining_pages(self, cursor):
+        decrypted_messages = []
+        while True:
+            auth = await self.__generate_auth_object()
+            r = await self.http_client.post(self.server_url + "/v1/user/" + self.username + "/message/pull",
+                                            params={"cursor": cursor, "limit": self.PULL_PAGE_SIZE}, json=auth)
+            if not self.__check_response(r, 200):
+                return decrypted_messages
+            messages = r.json()["messages"]
+            decrypted_messages.extend(await self.__decrypt_messages(messages))
+            if len(messages) < self.PULL_PAGE_SIZE:
+                if len(messages) > 0:
+                    await self.__ack_messages(r.json()["cursor"])
+                return decrypted_messages
+            cursor = r.json()["cursor"]
+
+    async def __ack_messages(self, cursor):
+        auth = await self.__generate_auth_object()
+        r = await self.http_client.post(self.server_url + "/v1/user/" + self.username + "/message/ack", json={
+            "auth": auth,
+            "cursor": cursor
+        })
+        return self.__check_response(r, 204)
+
+    async def __decrypt_messages(self, messages):
+        decrypted_objects = await asyncio.gather(*[self.__try_decrypting_message(message) for message in messages])
+        await self.__ensure_peers([decrypted_object["from"] for decrypted_object in decrypted_objects if decrypted_object is not None])
+        verified_messages = await asyncio.gather(*[self.__run_crypto(crypto.verify_message_contents, decrypted_object, self.peers)
+                                                   for decrypted_object in decrypted_objects if decrypted_object is not None])
+        return [verified_message for verified_message in verified_messages if len(verified_message["to"]) > 0]
+
+    async def __try_decrypting_message(self, message):
+        try:
+            return await self.__run_crypto(crypto.decrypt_message_contents, self.keypair, message)
+        except Exception:
+            return None
+
+    async def __generate_auth_object(self):
+        if self.USE_SESSIONS and (self.__has_valid_session() or await self.__ensure_session()):
+            return {"username": self.username, "token": self.session_token}
+        return await self.__generate_signed_auth_object()
+
+    async def __ensure_session(self):
+        # Concurrent requests would otherwise each sign a new time and race the server's increasing auth time check.
+        async with self.session_lock:
+            return self.__has_valid_session() or await self.__try_creating_session()
+
+    async def __generate_signed_auth_object(self):
+        current_date_time = crypto.current_date_time()
+        return {
+            "username": self.username,
+            "time": current_date_time.isoformat(),
+            "signature": await self.__run_crypto(crypto.generate_auth_signature, self.keypair, self.username, current_date_time)
+        }
+
+    def __generate_auth_headers(self, auth):
+        if "token" in auth:
+            return {"X-Auth-Token": auth["token"]}
+        return {"X-Auth-Time": auth["time"], "X-Auth-Signature": auth["signature"]}
+
+    def __has_valid_session(self):
+        return self.session_token is not None and self.session_expires - self.SESSION_REFRESH_MARGIN > crypto.current_date_time()
+
+    async def __try_creating_session(self):
+        r = await self.http_client.post(self.server_url + "/v1/user/" + self.username + "/session",
+                                        json=await self.__generate_signed_auth_object())
+        if r.status_code == 200:
+            self.session_token = r.json()["token"]
+            self.session_expires = datetime.fromisoformat(r.json()["expires"])
+            return True
+        else:
+            return False
+
+    def __check_response(self, r, expected_status_code):
+        if r.status_code == 401:
+            self.session_token = None
+        return r.status_code == expected_status_code
@@ -1,6 +1,10 @@
+import os
+import logging
 from .dao import FileBasedClientDAO
 from .service import ClientServices
 
+logging.basicConfig(level=os.environ.get("E2E_LOG_LEVEL", "WARNING").upper(), format="%(levelname)s %(name)s: %(message)s")
+
 print("######################################")
 print("### End-to-End Encrypted Messenger ###")
 print("######################################")
@@ -11,21 +15,27 @@ service = ClientServices(dao)
 
 while True:
     action = input(
-        "What would you like to do? [find-user, pull-messages, list-peers, view-conversation, send-message, exit]: ").strip().lower()
+        "What would you like to do? [find-user, pull-messages, wait-messages, list-peers, view-conversation, send-message, broadcast-message, exit]: ").strip().lower()
 
     if action == "find" or action == "find-user":
         service.find_user()
     elif action == "pull" or action == "pull-messages":
         service.pull_messages()
+    elif action == "wait" or action == "wait-messages":
+        service.wait_for_messages()
     elif action == "list" or action == "list-peers":
         service.list_peers()
     elif action == "view" or action == "view-conversation":
         service.view_conversation()
     elif action == "send" or action == "send-message":
         service.send_message()
+    elif action == "broadcast" or action == "broadcast-message":
+        service.broadcast_message()
     elif action == "exit":
         print("Have a good day.")
         break
     else:
         print(
-            "Action not recognized. Please choose from [find-user/find, pull-messages/pull, list-peers/list, view-conversation/view, send-message/send, exit].")
+            "Action not recognized. Please choose from [find-user/find, pull-messages/pull, wait-messages/wait, list-peers/list, view-conversation/view, send-message/send, broadcast-message/broadcast, exit].")
+
+service.close()
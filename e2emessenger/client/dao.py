@@ -1,7 +1,7 @@
 import os
-import json
 from abc import ABC, abstractmethod
 from ..crypto import crypto
+from ..serialization import serialization
 
 
 class ClientDAO(ABC):
@@ -14,11 +14,23 @@ class ClientDAO(ABC):
         pass
 
     @abstractmethod
-    def save_peers(self, peers):
+    def save_peer(self, username, public_key):
         pass
 
     @abstractmethod
-    def load_peers(self):
+    def load_peer(self, username):
+        pass
+
+    @abstractmethod
+    def list_peers(self):
+        pass
+
+    @abstractmethod
+    def append_conversation_messages(self, peer, messages):
+        pass
+
+    @abstractmethod
+    def load_conversation(self, peer):
         pass
 
 
@@ -62,32 +74,66 @@ class FileBasedClientDAO(ClientDAO):
         except IOError:
             return ('', '', '')
 
-    def save_peers(self, peers):
-        for peer in peers:
-            with open(os.path.join(self.base_dir, self.PEER_KEY_FOLDER_NAME, peer), "w+", encoding="utf-8") as peer_file:
-                peer_file.write(crypto.export_public_key(peers[peer]))
-
-    def load_peers(self):
-        peers = {}
-
-        for peer in os.listdir(os.path.join(self.base_dir, self.PEER_KEY_FOLDER_NAME)):
-            with open(os.path.join(self.base_dir, self.PEER_KEY_FOLDER_NAME, peer), "r", encoding="utf-8") as peer_file:
-                peers[peer] = crypto.import_public_key(peer_file.read())
-
-        return peers
-
-    def save_conversations(self, conversations):
-        for conversation in conversations:
-            with open(os.path.join(self.base_dir, self.CONVERSATION_KEY_FOLDER_NAME, conversation), "w+", encoding="utf-8") as conversation_file:
-                conversation_file.write(
-                    json.dumps(conversations[conversation]))
+    # Peer names come from the sender controlled "from" field of messages, so they must stay inside the peers folder.
+    def __peer_path(self, username):
+        if len(username) == 0 or username in (".", "..") or os.sep in username or (os.altsep is not None and os.altsep in username):
+            return None
+        return os.path.join(self.base_dir, self.PEER_KEY_FOLDER_NAME, username)
+
+    def save_peer(self, username, public_key):
+        peer_path = self.__peer_path(username)
+        if peer_path is None:
+            raise ValueError("Invalid peer name " + repr(username))
+        with open(peer_path, "w+", encoding="utf-8") as peer_file:
+            peer_file.write(crypto.export_public_key(public_key))
+
+    def load_peer(self, username):
+        peer_path = self.__peer_path(username)
+        if peer_path is None:
+            return None
+        try:
+            with open(peer_path, "r", encoding="utf-8") as peer_file:
+                return crypto.import_public_key(peer_file.read())
+        except (OSError, ValueError):
+            return None
 
-    def load_conversations(self):
-        conversations = {}
+    def list_peers(self):
+        return os.listdir(os.path.join(self.base_dir, self.PEER_KEY_FOLDER_NAME))
 
-        for conversation in os.listdir(os.path.join(self.base_dir, self.CONVERSATION_KEY_FOLDER_NAME)):
-            with open(os.path.join(self.base_dir, self.CONVERSATION_KEY_FOLDER_NAME, conversation), "r", encoding="utf-8") as conversation_file:
-                conversations[conversation] = json.loads(
-                    conversation_file.read())
+    def append_conversation_messages(self, peer, messages):
+        conversation_path = os.path.join(self.base_dir, self.CONVERSATION_KEY_FOLDER_NAME, peer)
+        self.__upgrade_legacy_conversation(conversation_path)
+        with open(conversation_path, "a", encoding="utf-8") as conversation_file:
+            conversation_file.write("".join(serialization.dumps(message) + "\n" for message in messages))
 
-        return conversations
+    def load_conversation(self, peer):
+        try:
+            with open(os.path.join(self.base_dir, self.CONVERSATION_KEY_FOLDER_NAME, peer), "r", encoding="utf-8") as conversation_file:
+                contents = conversation_file.read()
+        except FileNotFoundError:
+            return []
+
+        if contents.startswith("["):
+            return serialization.loads(contents)
+        messages = []
+        # Only "\n" ends a record, orjson writes U+2028, U+2029 and U+0085 unescaped and splitlines() would break on them.
+        for line in contents.split("\n"):
+            try:
+                messages.append(serialization.loads(line))
+            except ValueError:
+                pass
+        return messages
+
+    def __upgrade_legacy_conversation(self, conversation_path):
+        try:
+            with open(conversation_path, "r", encoding="utf-8") as conversation_file:
+                if conversation_file.read(1) != "[":
+                    return
+                conversation_file.seek(0)
+                messages = serialization.loads(conversation_file.read())
+        except FileNotFoundError:
+            return
+
+        with open(conversation_path + ".tmp", "w", encoding="utf-8") as conversation_file:
+            conversation_file.write("".join(serialization.dumps(message) + "\n" for message in messages))
+        os.replace(conversation_path + ".tmp", conversation_path)
@@ -1,14 +1,95 @@
+import time
+import logging
 from getpass import getpass
+from collections.abc import Mapping
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from ..crypto import crypto
 
 
+logger = logging.getLogger(__name__)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    def __init__(self, timeout, *args, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+class PeerKeyCache(Mapping):
+    def __init__(self, dao):
+        self.dao = dao
+        self.public_keys = {}
+
+    def __getitem__(self, username):
+        if username not in self.public_keys:
+            public_key = self.dao.load_peer(username)
+            if public_key is None:
+                raise KeyError(username)
+            self.public_keys[username] = public_key
+        return self.public_keys[username]
+
+    def __contains__(self, username):
+        try:
+            self[username]
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        return iter(self.dao.list_peers())
+
+    def __len__(self):
+        return len(self.dao.list_peers())
+
+    def add(self, username, public_key):
+        self.dao.save_peer(username, public_key)
+        self.public_keys[username] = public_key
+
+
 class ClientServices():
+    ENCRYPTION_THREADS = 8
+    DECRYPTION_THREADS = 8
+    WAIT_TIMEOUT = 30
+    PULL_PAGE_SIZE = 100
+    USE_SESSIONS = True
+    SESSION_REFRESH_MARGIN = timedelta(seconds=30)
+    REQUEST_TIMEOUT = 10
+    REQUEST_RETRIES = 3
+    RETRY_BACKOFF = 0.5
+
     def __init__(self, dao):
         self.dao = dao
+        self.http_session = self.__create_http_session()
+        self.executor = ThreadPoolExecutor(max_workers=max(self.ENCRYPTION_THREADS, self.DECRYPTION_THREADS))
+        self.session_token = None
+        self.session_expires = datetime.min
+        self.last_pull_timings = {}
         (self.server_url, self.username, self.keypair) = self.initialize()
-        self.peers = self.dao.load_peers()
-        self.conversations = self.dao.load_conversations()
+        self.peers = PeerKeyCache(self.dao)
+        self.conversations = {}
+
+    def close(self):
+        self.executor.shutdown()
+        self.http_session.close()
+
+    def __create_http_session(self):
+        retry = Retry(total=self.REQUEST_RETRIES, backoff_factor=self.RETRY_BACKOFF,
+                      status_forcelist=[502, 503, 504], allowed_methods=["GET"])
+        adapter = TimeoutHTTPAdapter(self.REQUEST_TIMEOUT, pool_connections=1,
+                                     pool_maxsize=max(self.ENCRYPTION_THREADS, self.DECRYPTION_THREADS), max_retries=retry)
+        http_session = requests.Session()
+        http_session.mount("http://", adapter)
+        http_session.mount("https://", adapter)
+        return http_session
 
     def initialize(self):
         (server_url, username, keypair) = self.dao.load_user_data()
@@ -40,7 +121,7 @@ class ClientServices():
 
     def __try_ping(self, proposed_server_url):
         try:
-            r = requests.get(proposed_server_url + "/v1/health")
+            r = self.http_session.get(proposed_server_url + "/v1/health")
             return r.status_code == 200
         except Exception:
             return False
@@ -56,7 +137,7 @@ class ClientServices():
                     "That username appears to be taken. You will need to pick a different one.")
 
     def __try_register(self, server_url, proposed_username, pub_key):
-        r = requests.put(server_url + "/v1/user/register", json={
+        r = self.http_session.put(server_url + "/v1/user/register", json={
             "username": proposed_username,
             "public_key": crypto.export_public_key(pub_key),
             "time": crypto.current_date_time().isoformat()})
@@ -87,15 +168,10 @@ class ClientServices():
 
     def __try_adding_user_public_key(self, username):
         public_key = self.__find_user_public_key(username)
-        if len(public_key) > 0:
-            self.peers[username] = crypto.import_public_key(public_key)
-            self.dao.save_peers(self.peers)
-            return True
-        else:
-            return False
+        return len(public_key) > 0 and self.__try_adding_peer(username, public_key)
 
     def __find_user_public_key(self, to_search):
-        r = requests.get(self.server_url + "/v1/user/" + to_search)
+        r = self.http_session.get(self.server_url + "/v1/user/" + to_search)
         if r.status_code == 200:
             return r.json()['public_key']
         else:
@@ -108,58 +184,159 @@ class ClientServices():
         print()
 
     def pull_messages(self):
-        messages = self.__pull_messages_from_server()
-        if len(messages) > 0:
-            for encrypted_message in messages:
-                self.__input_and_verify_message(encrypted_message)
-            self.dao.save_conversations(self.conversations)
-        else:
+        if self.__pull_remaining_pages(0) == 0:
             print("Looks like there is nothing new.")
         print()
 
-    def __pull_messages_from_server(self):
+    def wait_for_messages(self):
+        print("Waiting for new messages, press Ctrl-C to stop waiting.")
+        try:
+            while True:
+                (messages, cursor) = self.__wait_for_messages_from_server()
+                if cursor is None:
+                    break
+                if len(messages) > 0:
+                    self.__input_and_verify_messages(messages)
+                    if len(messages) < self.PULL_PAGE_SIZE:
+                        self.__ack_messages_on_server(cursor)
+                    else:
+                        self.__pull_remaining_pages(cursor)
+                    break
+        except KeyboardInterrupt:
+            print("Stopped waiting.")
+        print()
+
+    def __pull_remaining_pages(self, cursor):
+        pulled = 0
+        while True:
+            (messages, next_cursor) = self.__pull_messages_from_server(cursor)
+            if next_cursor is None:
+                return pulled
+            if len(messages) > 0:
+                self.__input_and_verify_messages(messages)
+                pulled += len(messages)
+            if len(messages) < self.PULL_PAGE_SIZE:
+                if len(messages) > 0:
+                    self.__ack_messages_on_server(next_cursor)
+                return pulled
+            cursor = next_cursor
+
+    def __input_and_verify_messages(self, messages):
+        timings = {}
+        start = time.perf_counter()
+        decrypted_objects = list(self.executor.map(self.__try_decrypting_message, messages))
+        timings["decrypt"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        self.__add_missing_peers(decrypted_objects)
+        timings["peer_lookup"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        decrypted_messages = list(self.executor.map(self.__verify_decrypted_message, decrypted_objects))
+        timings["verify"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        received_messages = {}
+        for decrypted_message in decrypted_messages:
+            if len(decrypted_message["to"]) == 0:
+                print("Illegal message found, ignoring")
+            else:
+                received_messages.setdefault(decrypted_message["from"], []).append({
+                    "sent": False, "time": decrypted_message["time"], "message": decrypted_message["message"]})
+                print("Pulled down message from " + decrypted_message["from"])
+        for (peer, conversation_contents) in received_messages.items():
+            self.__add_to_conversation(peer, conversation_contents)
+        timings["save"] = time.perf_counter() - start
+
+        self.last_pull_timings = timings
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Processed %d messages in %.3fs (%s)", len(messages), sum(timings.values()),
+                         ", ".join(stage + " " + format(duration, ".3f") + "s" for (stage, duration) in timings.items()))
+
+    def __try_decrypting_message(self, encrypted_message):
+        try:
+            return crypto.decrypt_message_contents(self.keypair, encrypted_message)
+        except Exception:
+            return None
+
+    def __add_missing_peers(self, decrypted_objects):
+        missing_peers = []
+        for decrypted_object in decrypted_objects:
+            if decrypted_object is not None and len(decrypted_object["from"]) > 0 and \
+                    decrypted_object["from"] not in self.peers and decrypted_object["from"] not in missing_peers:
+                missing_peers.append(decrypted_object["from"])
+        if len(missing_peers) == 0:
+            return
+
+        print("Received messages from users not in peer list, trying to obtain their public keys...")
+        found_keys = list(self.executor.map(self.__find_user_public_key, missing_peers))
+        for (username, public_key) in zip(missing_peers, found_keys):
+            if len(public_key) > 0 and self.__try_adding_peer(username, public_key):
+                print("User " + username + " found.")
+            else:
+                print("User " + username + " not found, ignoring their messages.")
+
+    def __try_adding_peer(self, username, public_key):
+        try:
+            self.peers.add(username, crypto.import_public_key(public_key))
+            return True
+        except ValueError:
+            return False
+
+    def __verify_decrypted_message(self, decrypted_object):
+        if decrypted_object is None:
+            return {"to": "", "from": "", "time": "", "message": "", "hash": "", "signature": ""}
+        return crypto.verify_message_contents(decrypted_object, self.peers)
+
+    def __pull_messages_from_server(self, cursor):
         auth = self.__generate_auth_object()
-        r = requests.post(self.server_url + "/v1/user/" +
-                          self.username + "/message/pull", json=auth)
+        r = self.http_session.post(self.server_url + "/v1/user/" + self.username + "/message/pull",
+                                   params={"cursor": cursor, "limit": self.PULL_PAGE_SIZE}, json=auth)
         if r.status_code == 200:
-            return r.json()["messages"]
+            return (r.json()["messages"], r.json()["cursor"])
         else:
+            self.__forget_session_on_auth_failure(r)
             print("Oops, something went wrong pulling your messages.")
-            return []
+            return ([], None)
 
-    def __input_and_verify_message(self, encrypted_message):
-        decrypted_message = crypto.decrypt_message(
-            self.keypair, self.peers, encrypted_message)
-        if self.__is_missing_peer(decrypted_message):
-            print(
-                "Received message from user not in peer list, trying to obtain their public key...")
-            if self.__try_adding_user_public_key(decrypted_message["from"]):
-                print("User found, attempting decryption again.")
-                decrypted_message = crypto.decrypt_message(
-                    self.keypair, self.peers, encrypted_message)
-            else:
-                print("User not found, ignoring.")
-
-        if len(decrypted_message["to"]) == 0:
-            print("Illegal message found, ignoring")
+    def __wait_for_messages_from_server(self):
+        auth = self.__generate_auth_object()
+        r = self.http_session.post(self.server_url + "/v1/user/" + self.username + "/message/wait",
+                                   params={"timeout": self.WAIT_TIMEOUT, "cursor": 0, "limit": self.PULL_PAGE_SIZE},
+                                   json=auth, timeout=self.WAIT_TIMEOUT + 10)
+        if r.status_code == 200:
+            return (r.json()["messages"], r.json()["cursor"])
         else:
-            self.__add_message_to_conversations(decrypted_message)
+            self.__forget_session_on_auth_failure(r)
+            print("Oops, something went wrong waiting for your messages.")
+            return ([], None)
 
-    def __is_missing_peer(self, decrypted_message):
-        return len(decrypted_message["to"]) == 0 and len(decrypted_message["from"]) > 0
+    def __ack_messages_on_server(self, cursor):
+        auth = self.__generate_auth_object()
+        r = self.http_session.post(self.server_url + "/v1/user/" + self.username + "/message/ack", json={
+            "auth": auth,
+            "cursor": cursor
+        })
+        if r.status_code != 204:
+            self.__forget_session_on_auth_failure(r)
+            print("Oops, something went wrong acknowledging your messages.")
 
-    def __add_message_to_conversations(self, decrypted_message):
-        conversation_contents = {
-            "sent": False, "time": decrypted_message["time"], "message": decrypted_message["message"]}
-        if decrypted_message["from"] in self.conversations:
-            self.conversations[decrypted_message["from"]].append(
-                conversation_contents)
-        else:
-            self.conversations[decrypted_message["from"]] = [
-                conversation_contents]
-        print("Pulled down message from " + decrypted_message["from"])
+    def __add_to_conversation(self, peer, conversation_contents):
+        self.dao.append_conversation_messages(peer, conversation_contents)
+        if peer in self.conversations:
+            self.conversations[peer].extend(conversation_contents)
+
+    def __load_conversation(self, peer):
+        if peer not in self.conversations:
+            self.conversations[peer] = self.dao.load_conversation(peer)
+        return self.conversations[peer]
 
     def __generate_auth_object(self):
+        if self.USE_SESSIONS and (self.__has_valid_session() or self.__try_creating_session()):
+            return {"username": self.username, "token": self.session_token}
+        return self.__generate_signed_auth_object()
+
+    def __generate_signed_auth_object(self):
         current_date_time = crypto.current_date_time()
         return {
             "username": self.username,
@@ -167,10 +344,33 @@ class ClientServices():
             "signature": crypto.generate_auth_signature(self.keypair, self.username, current_date_time)
         }
 
+    def __generate_auth_headers(self, auth):
+        if "token" in auth:
+            return {"X-Auth-Token": auth["token"]}
+        return {"X-Auth-Time": auth["time"], "X-Auth-Signature": auth["signature"]}
+
+    def __has_valid_session(self):
+        return self.session_token is not None and self.session_expires - self.SESSION_REFRESH_MARGIN > crypto.current_date_time()
+
+    def __try_creating_session(self):
+        r = self.http_session.post(self.server_url + "/v1/user/" + self.username + "/session",
+                                   json=self.__generate_signed_auth_object())
+        if r.status_code == 200:
+            self.session_token = r.json()["token"]
+            self.session_expires = datetime.fromisoformat(r.json()["expires"])
+            return True
+        else:
+            return False
+
+    def __forget_session_on_auth_failure(self, r):
+        if r.status_code == 401:
+            self.session_token = None
+
     def view_conversation(self):
         other = input("Which conversation do you want to view? ")
-        if other in self.conversations:
-            for message in self.conversations[other]:
+        conversation = self.__load_conversation(other)
+        if len(conversation) > 0:
+            for message in conversation:
                 self.__print_conversation_message(
                     message["sent"], message["time"], message["message"])
             print()
@@ -206,26 +406,64 @@ class ClientServices():
 
         to_send = input("What would you like to say? ")
         self.__send_message_to_server(recipient, to_send)
-        conversation_contents = {
-            "sent": True, "time": crypto.current_date_time().isoformat(), "message": to_send}
-        if recipient in self.conversations:
-            self.conversations[recipient].append(conversation_contents)
-        else:
-            self.conversations[recipient] = [conversation_contents]
-        self.dao.save_conversations(self.conversations)
+        self.__add_to_conversation(recipient, [self.__generate_sent_conversation_contents(to_send)])
+        print()
+
+    def __generate_sent_conversation_contents(self, message):
+        return {"sent": True, "time": crypto.current_date_time().isoformat(), "message": message}
+
+    def broadcast_message(self):
+        recipients = []
+        for recipient in input("Who would you like to send a message to? (separate usernames with commas) ").split(","):
+            recipient = recipient.strip()
+            if len(recipient) == 0 or recipient in recipients:
+                continue
+            if recipient in self.peers or self.__try_adding_user_public_key(recipient):
+                recipients.append(recipient)
+            else:
+                print("No one by the username " + recipient + " seems to exist, skipping them.")
+
+        if len(recipients) == 0:
+            print("There is no one to send the message to.")
+            print()
+            return
+
+        to_send = input("What would you like to say? ")
+        self.__send_messages_to_server(recipients, to_send)
+        conversation_contents = self.__generate_sent_conversation_contents(to_send)
+        for recipient in recipients:
+            self.__add_to_conversation(recipient, [conversation_contents])
         print()
 
     def __send_message_to_server(self, recipient, message_contents):
         auth = self.__generate_auth_object()
-        encrypted_message = crypto.encrypt_message(
+        encrypted_message = crypto.encrypt_message_bytes(
             self.keypair, self.peers[recipient], self.username, recipient, crypto.current_date_time(), message_contents)
 
-        r = requests.put(self.server_url + "/v1/user/" + self.username + "/message/send", json={
+        r = self.http_session.put(self.server_url + "/v1/user/" + self.username + "/message/send-binary",
+                                  params={"recipient": recipient}, data=encrypted_message, headers={
+                                      "Content-Type": "application/octet-stream",
+                                      **self.__generate_auth_headers(auth)
+                                  })
+        if r.status_code == 204:
+            print("Message sent!")
+        else:
+            self.__forget_session_on_auth_failure(r)
+            print("Oops, something went wrong sending that message.")
+
+    def __send_messages_to_server(self, recipients, message_contents):
+        auth = self.__generate_auth_object()
+        send_time = crypto.current_date_time()
+        encrypted_messages = list(self.executor.map(lambda recipient: crypto.encrypt_message(
+            self.keypair, self.peers[recipient], self.username, recipient, send_time, message_contents), recipients))
+
+        r = self.http_session.put(self.server_url + "/v1/user/" + self.username + "/message/send-batch", json={
             "auth": auth,
-            "recipient": recipient,
-            "message": encrypted_message
+            "messages": [{"recipient": recipient, "message": encrypted_message}
+                         for (recipient, encrypted_message) in zip(recipients, encrypted_messages)]
         })
         if r.status_code == 204:
-            print("Message sent!")
+            print("Message sent to " + str(len(recipients)) + " users!")
         else:
+            self.__forget_session_on_auth_failure(r)
             print("Oops, something went wrong sending that message.")
@@ -1,12 +1,32 @@
+import os
+import time
+import hmac
 import base64
+import hashlib
 import json
+import struct
+import logging
+import threading
 from datetime import datetime
 from cryptography.hazmat.primitives.asymmetric import rsa, padding, utils
 from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.exceptions import InvalidSignature
+from ..serialization import serialization as json_serialization
 
 
-DETAILED_OUTPUT = True
+logger = logging.getLogger(__name__)
+
+LOG_MESSAGE_CONTENTS = os.environ.get("E2E_LOG_MESSAGE_CONTENTS") == "1"
+STAGE_TIMING = os.environ.get("E2E_CRYPTO_TIMING") == "1"
+
+LEGACY_MESSAGE_FORMAT = 1
+HYBRID_MESSAGE_FORMAT = 2
+MESSAGE_FORMAT = HYBRID_MESSAGE_FORMAT
+
+SIGNATURE_PADDING = padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH)
+SIGNATURE_ALGORITHM = utils.Prehashed(hashes.SHA256())
+MESSAGE_PADDING = padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
 
 # Keys
 
@@ -37,6 +57,41 @@ def import_public_key(public_key_contents):
     return serialization.load_pem_public_key(public_key_contents.encode('utf-8'))
 
 
+# Instrumentation
+
+__stage_timings = {}
+__stage_timings_lock = threading.Lock()
+
+
+def stage_timings():
+    with __stage_timings_lock:
+        return {stage: dict(timing) for (stage, timing) in __stage_timings.items()}
+
+
+def reset_stage_timings():
+    with __stage_timings_lock:
+        __stage_timings.clear()
+
+
+def __timed(stage, function, *args):
+    if not STAGE_TIMING:
+        return function(*args)
+    start = time.perf_counter()
+    result = function(*args)
+    duration = time.perf_counter() - start
+    with __stage_timings_lock:
+        timing = __stage_timings.setdefault(stage, {"count": 0, "seconds": 0.0})
+        timing["count"] += 1
+        timing["seconds"] += duration
+    logger.debug("Crypto stage %s took %.6fs", stage, duration)
+    return result
+
+
+def __log_contents(description, contents):
+    if LOG_MESSAGE_CONTENTS and logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s: %s", description, contents() if callable(contents) else contents)
+
+
 # Signatures
 
 def current_date_time():
@@ -44,29 +99,25 @@ def current_date_time():
 
 
 def generate_auth_signature(private_key, username, date_time):
-    return __sign_hashed(__hash_string(__generate_auth_string_to_sign(username, date_time)), private_key)
+    return __encode(__timed("auth_sign", __sign_hashed, __hash_string(__generate_auth_string_to_sign(username, date_time)), private_key))
 
 
-def __sign_hashed(encoded_hash, private_key):
-    decoded_hash = base64.b64decode(encoded_hash)
-    signature = private_key.sign(
-        decoded_hash, __get_signature_padding(), utils.Prehashed(__get_hash_algorithm()))
-    return base64.b64encode(signature).decode('utf-8')
+def __sign_hashed(digest, private_key):
+    return private_key.sign(digest, SIGNATURE_PADDING, SIGNATURE_ALGORITHM)
 
 
 def verify_auth_signature(public_key, signature, username, date_time):
-    return __verify_signed_hash(__hash_string(
-        __generate_auth_string_to_sign(username, date_time)), signature, public_key)
+    try:
+        decoded_signature = base64.b64decode(signature)
+    except ValueError:
+        return False
+    return __timed("auth_verify", __verify_signed_hash, __hash_string(
+        __generate_auth_string_to_sign(username, date_time)), decoded_signature, public_key)
 
 
-def __verify_signed_hash(encoded_hash, signature, public_key):
+def __verify_signed_hash(digest, signature, public_key):
     try:
-        decoded_hash = base64.b64decode(encoded_hash)
-        decoded_signature = base64.b64decode(signature)
-        public_key.verify(decoded_signature,
-                          decoded_hash,
-                          __get_signature_padding(),
-                          utils.Prehashed(__get_hash_algorithm()))
+        public_key.verify(signature, digest, SIGNATURE_PADDING, SIGNATURE_ALGORITHM)
         return True
     except InvalidSignature:
         return False
@@ -77,53 +128,109 @@ def __generate_auth_string_to_sign(username, date_time):
 
 
 def __hash_string(string_to_hash):
-    digest = hashes.Hash(__get_hash_algorithm())
-    digest.update(string_to_hash.encode('utf-8'))
-    return base64.b64encode(digest.finalize()).decode('utf-8')
+    return hashlib.sha256(string_to_hash.encode('utf-8')).digest()
+
+
+def __encode(raw_bytes):
+    return base64.b64encode(raw_bytes).decode('utf-8')
 
+# Sessions
 
-def __get_signature_padding():
-    return padding.PSS(mgf=padding.MGF1(hashes.SHA256()),
-                       salt_length=padding.PSS.MAX_LENGTH)
 
+def generate_session_secret():
+    return os.urandom(32)
+
+
+def generate_session_token(secret, username, expires):
+    payload = __generate_session_payload(username, expires)
+    return base64.urlsafe_b64encode(payload).decode('utf-8') + __get_token_separator() + \
+        base64.urlsafe_b64encode(__sign_session_payload(secret, payload)).decode('utf-8')
+
+
+def verify_session_token(secret, token, username, date_time):
+    try:
+        (encoded_payload, encoded_mac) = token.split(__get_token_separator())
+        payload = base64.urlsafe_b64decode(encoded_payload)
+        if not hmac.compare_digest(base64.urlsafe_b64decode(encoded_mac), __sign_session_payload(secret, payload)):
+            return False
+        (expires, token_username) = payload.decode('utf-8').split(" ", 1)
+        return token_username == username and datetime.fromisoformat(expires) > date_time
+    except ValueError:
+        return False
 
-def __get_hash_algorithm():
-    return hashes.SHA256()
+
+def __generate_session_payload(username, expires):
+    return (expires.isoformat() + " " + username).encode('utf-8')
+
+
+def __sign_session_payload(secret, payload):
+    return hmac.new(secret, payload, hashlib.sha256).digest()
+
+
+def __get_token_separator():
+    return "."
 
 # Messages
 
 
 def encrypt_message(sender_private_key, receiver_public_key, sender, receiver, time, message):
-    hash_contents = __hash_string(
+    final_contents = __generate_signed_message_string(
+        sender_private_key, sender, receiver, time, message)
+    if MESSAGE_FORMAT == LEGACY_MESSAGE_FORMAT:
+        ciphertext = __timed("encrypt", __encrypt_long_message, receiver_public_key, final_contents)
+    else:
+        ciphertext = __encode(__timed("encrypt", __encrypt_envelope, receiver_public_key, final_contents))
+    logger.debug("Encrypted message from %s to %s into %d characters", sender, receiver, len(ciphertext))
+    __log_contents("Sending encrypted message", ciphertext)
+    return ciphertext
+
+
+def encrypt_message_bytes(sender_private_key, receiver_public_key, sender, receiver, time, message):
+    final_contents = __generate_signed_message_string(
+        sender_private_key, sender, receiver, time, message)
+    envelope = __timed("encrypt", __encrypt_envelope, receiver_public_key, final_contents)
+    logger.debug("Encrypted message from %s to %s into %d bytes", sender, receiver, len(envelope))
+    __log_contents("Sending encrypted message", lambda: __encode(envelope))
+    return envelope
+
+
+def __generate_signed_message_string(sender_private_key, sender, receiver, time, message):
+    digest = __hash_string(
         __generate_message_string_to_sign(sender, receiver, time, message))
-    signature_contents = __sign_hashed(hash_contents, sender_private_key)
+    signature = __timed("sign", __sign_hashed, digest, sender_private_key)
     final_contents = __generate_final_message_string(
-        sender, receiver, time, message, hash_contents, signature_contents)
-    if DETAILED_OUTPUT:
-        print("Encrypting message with following contents: " + final_contents)
-    ciphertext = __encrypt_long_message(receiver_public_key, final_contents)
-    if DETAILED_OUTPUT:
-        print("Sending encrypted message: " + ciphertext)
-    return ciphertext
+        sender, receiver, time, message, __encode(digest), __encode(signature))
+    __log_contents("Encrypting message with following contents", final_contents)
+    return final_contents
 
 
 def __generate_final_message_string(sender, receiver, time, message, encoded_hash, encoded_signature):
-    return json.dumps({"from": sender, "to": receiver, "time": time.isoformat(), "message": message, "hash": encoded_hash, "signature": encoded_signature})
+    contents = {"from": sender, "to": receiver, "time": time.isoformat(), "message": message, "hash": encoded_hash, "signature": encoded_signature}
+    # The legacy format encrypts 100 character chunks with RSA, which only fit if every character is a single byte.
+    if MESSAGE_FORMAT == LEGACY_MESSAGE_FORMAT:
+        return json.dumps(contents)
+    return json_serialization.dumps(contents)
 
 
 def __encrypt_long_message(public_key, message):
     split_contents = __split_long_message(message)
     final_encrypted = ""
     for part in split_contents:
-        encrypted = public_key.encrypt(
-            part.encode('utf-8'), __get_message_padding())
-        encoded_encrypted = base64.b64encode(encrypted).decode('utf-8')
-        final_encrypted += encoded_encrypted
+        encrypted = public_key.encrypt(part.encode('utf-8'), MESSAGE_PADDING)
+        final_encrypted += __encode(encrypted)
         if not __is_last_element(part, split_contents):
             final_encrypted += __get_message_separator()
     return final_encrypted
 
 
+def __encrypt_envelope(public_key, message):
+    key = AESGCM.generate_key(bit_length=256)
+    nonce = os.urandom(12)
+    wrapped_key = public_key.encrypt(key, MESSAGE_PADDING)
+    header = struct.pack(">BH", HYBRID_MESSAGE_FORMAT, len(wrapped_key)) + wrapped_key + struct.pack(">B", len(nonce)) + nonce
+    return header + AESGCM(key).encrypt(nonce, message.encode('utf-8'), header)
+
+
 def __split_long_message(message):
     return [message[i:i+100] for i in range(0, len(message), 100)]
 
@@ -133,18 +240,29 @@ def __is_last_element(element, list_to_check):
 
 
 def decrypt_message(receiver_private_key, peer_public_keys, ciphertext):
-    if DETAILED_OUTPUT:
-        print("Received encrypted message: " + ciphertext)
-    decrypted_message = __decrypt_long_message(
-        receiver_private_key, ciphertext)
-    decrypted_object = json.loads(decrypted_message)
-    if DETAILED_OUTPUT:
-        print("Decrypted message into: " + decrypted_message)
+    return verify_message_contents(decrypt_message_contents(receiver_private_key, ciphertext), peer_public_keys)
+
+
+def decrypt_message_contents(receiver_private_key, ciphertext):
+    if isinstance(ciphertext, str) and __get_message_separator() in ciphertext:
+        __log_contents("Received encrypted message", ciphertext)
+        decrypted_message = __timed("decrypt", __decrypt_long_message, receiver_private_key, ciphertext)
+    else:
+        envelope = ciphertext if isinstance(
+            ciphertext, bytes) else base64.b64decode(ciphertext)
+        __log_contents("Received encrypted message", lambda: __encode(envelope))
+        decrypted_message = __timed("decrypt", __decrypt_envelope, receiver_private_key, envelope)
+    decrypted_object = json_serialization.loads(decrypted_message)
+    logger.debug("Decrypted message from %s", decrypted_object.get("from"))
+    __log_contents("Decrypted message into", decrypted_message)
+    return decrypted_object
+
 
+def verify_message_contents(decrypted_object, peer_public_keys):
     if decrypted_object["from"] not in peer_public_keys:
         return {"to": "", "from": decrypted_object["from"], "time": "", "message": "", "hash": "", "signature": ""}
 
-    if __verify_decrypted_message(decrypted_object, peer_public_keys):
+    if __timed("verify", __verify_decrypted_message, decrypted_object, peer_public_keys):
         return decrypted_object
     else:
         return {"to": "", "from": "", "time": "", "message": "", "hash": "", "signature": ""}
@@ -155,39 +273,56 @@ def __decrypt_long_message(private_key, message):
     final_decrypted_message = ""
     for part in parts:
         decoded_ciphertext = base64.b64decode(part)
-        decrypted_part = private_key.decrypt(
-            decoded_ciphertext, __get_message_padding()).decode('utf-8')
+        decrypted_part = private_key.decrypt(decoded_ciphertext, MESSAGE_PADDING).decode('utf-8')
         final_decrypted_message += decrypted_part
     return final_decrypted_message
 
 
+def __decrypt_envelope(private_key, envelope):
+    (version, wrapped_key_length) = struct.unpack_from(">BH", envelope)
+    if version != HYBRID_MESSAGE_FORMAT:
+        raise ValueError("Unsupported message format " + str(version))
+    offset = struct.calcsize(">BH")
+    wrapped_key = envelope[offset:offset + wrapped_key_length]
+    offset += wrapped_key_length
+    nonce_length = envelope[offset]
+    nonce = envelope[offset + 1:offset + 1 + nonce_length]
+    offset += 1 + nonce_length
+    key = private_key.decrypt(wrapped_key, MESSAGE_PADDING)
+    return AESGCM(key).decrypt(nonce, envelope[offset:], envelope[:offset]).decode('utf-8')
+
+
 def __split_encrypted_into_parts(encrypted_message):
     return encrypted_message.split(__get_message_separator())
 
 
 def __verify_decrypted_message(decrypted_object, peer_public_keys):
-    if DETAILED_OUTPUT:
-        print("Verifying integrity of message.")
-    calculated_hash = __hash_string(
+    logger.debug("Verifying integrity of message from %s", decrypted_object["from"])
+    calculated_digest = __hash_string(
         __generate_message_string_to_sign(decrypted_object["from"], decrypted_object["to"], datetime.fromisoformat(decrypted_object["time"]), decrypted_object["message"]))
 
     if decrypted_object["from"] not in peer_public_keys:
-        print("Peer public key not found.")
+        logger.warning("Peer public key not found for %s", decrypted_object["from"])
         return False
 
-    if DETAILED_OUTPUT:
-        print("Given hash:      " + decrypted_object["hash"])
-        print("Calculated hash: " + calculated_hash)
+    __log_contents("Given hash", decrypted_object["hash"])
+    __log_contents("Calculated hash", lambda: __encode(calculated_digest))
+
+    try:
+        given_digest = base64.b64decode(decrypted_object["hash"])
+        given_signature = base64.b64decode(decrypted_object["signature"])
+    except ValueError:
+        return False
 
-    if calculated_hash != decrypted_object["hash"]:
+    if not hmac.compare_digest(calculated_digest, given_digest):
+        logger.warning("Hash mismatch on message from %s", decrypted_object["from"])
         return False
 
-    if __verify_signed_hash(decrypted_object["hash"], decrypted_object["signature"], peer_public_keys[decrypted_object["from"]]):
-        if DETAILED_OUTPUT:
-            print("Verified signature '" +
-                  decrypted_object["signature"] + "' is from " + decrypted_object["from"] + " for these message contents")
+    if __verify_signed_hash(calculated_digest, given_signature, peer_public_keys[decrypted_object["from"]]):
+        logger.debug("Verified signature is from %s for these message contents", decrypted_object["from"])
         return True
     else:
+        logger.warning("Invalid signature on message from %s", decrypted_object["from"])
         return False
 
 
@@ -197,11 +332,3 @@ def __get_message_separator():
 
 def __generate_message_string_to_sign(sender, receiver, time, message):
     return sender + " " + receiver + " " + time.isoformat() + " " + message
-
-
-def __get_message_padding():
-    return padding.OAEP(
-        mgf=padding.MGF1(algorithm=hashes.SHA256()),
-        algorithm=hashes.SHA256(),
-        label=None
-    )
@@ -0,0 +1,95 @@
+import os
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+ORJSON_BACKEND = "orjson"
+UJSON_BACKEND = "ujson"
+STDLIB_BACKEND = "json"
+
+
+class StdlibSerializer():
+    name = STDLIB_BACKEND
+
+    def dumps(self, value, default=None):
+        return json.dumps(value, default=default, separators=(",", ":"))
+
+    def dumps_bytes(self, value, default=None):
+        return self.dumps(value, default).encode('utf-8')
+
+    def loads(self, contents):
+        return json.loads(contents)
+
+
+class OrjsonSerializer():
+    name = ORJSON_BACKEND
+
+    def dumps(self, value, default=None):
+        return orjson.dumps(value, default=default).decode('utf-8')
+
+    def dumps_bytes(self, value, default=None):
+        return orjson.dumps(value, default=default)
+
+    def loads(self, contents):
+        return orjson.loads(contents)
+
+
+class UjsonSerializer():
+    name = UJSON_BACKEND
+
+    def __init__(self):
+        self.fallback = StdlibSerializer()
+
+    # The pinned ujson has no default hook, so values that need one (binary messages) go through the standard library.
+    def dumps(self, value, default=None):
+        if default is not None:
+            return self.fallback.dumps(value, default)
+        return ujson.dumps(value, escape_forward_slashes=False)
+
+    def dumps_bytes(self, value, default=None):
+        return self.dumps(value, default).encode('utf-8')
+
+    def loads(self, contents):
+        return ujson.loads(contents)
+
+
+SERIALIZERS = [(ORJSON_BACKEND, orjson, OrjsonSerializer), (UJSON_BACKEND, ujson, UjsonSerializer), (STDLIB_BACKEND, json, StdlibSerializer)]
+
+
+def available_backends():
+    return [backend for (backend, module, serializer_class) in SERIALIZERS if module is not None]
+
+
+def create_serializer(backend=""):
+    for (name, module, serializer_class) in SERIALIZERS:
+        if module is not None and (backend == "" or backend == name):
+            return serializer_class()
+    raise ValueError("JSON backend " + backend + " is not available")
+
+
+serializer = create_serializer(os.environ.get("E2E_JSON_BACKEND", ""))
+
+
+def backend():
+    return serializer.name
+
+
+def dumps(value, default=None):
+    return serializer.dumps(value, default)
+
+
+def dumps_bytes(value, default=None):
+    return serializer.dumps_bytes(value, default)
+
+
+def loads(contents):
+    return serializer.loads(contents)
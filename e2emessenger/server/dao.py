@@ -1,10 +1,107 @@
 import os
-import json
+import time
+import bisect
+import base64
+import zlib
+import sqlite3
+import logging
+import threading
 from datetime import datetime
 from abc import ABC, abstractmethod
+from .metrics import timed_stage
+from ..serialization import serialization
+
+
+logger = logging.getLogger(__name__)
+
+BINARY_MESSAGE_NAME = "binary"
+BINARY_LENGTH_NAME = "binary_length"
+
+
+def encode_binary_message(value):
+    if isinstance(value, bytes):
+        return {BINARY_MESSAGE_NAME: base64.b64encode(value).decode('utf-8')}
+    raise TypeError("Cannot serialize " + type(value).__name__)
+
+
+def dumps_stored_record(record):
+    # Binary messages are written as raw bytes right after the JSON line, which only holds their length.
+    binary_values = []
+
+    def encode_binary_value(value):
+        if isinstance(value, bytes):
+            binary_values.append(value)
+            return {BINARY_LENGTH_NAME: len(value)}
+        raise TypeError("Cannot serialize " + type(value).__name__)
+
+    return serialization.dumps_bytes(record, default=encode_binary_value) + b"\n" + b"".join(binary_values)
+
+
+def read_exactly(stored_file, length):
+    contents = stored_file.read(length)
+    if len(contents) != length:
+        raise EOFError("Stored binary message is truncated")
+    return contents
+
+
+def decode_stored_message(message, stored_file=None):
+    if isinstance(message, dict):
+        if BINARY_LENGTH_NAME in message:
+            return read_exactly(stored_file, message[BINARY_LENGTH_NAME])
+        return base64.b64decode(message[BINARY_MESSAGE_NAME])
+    return message
+
+
+def decode_stored_user(user, loaded_time, stored_file=None):
+    user[InMemoryServerDAO.MESSAGES_NAME] = [decode_stored_message(message, stored_file)
+                                             for message in user[InMemoryServerDAO.MESSAGES_NAME]]
+    if len(user.get(InMemoryServerDAO.MESSAGE_TIMES_NAME, [])) != len(user[InMemoryServerDAO.MESSAGES_NAME]):
+        user[InMemoryServerDAO.MESSAGE_TIMES_NAME] = [loaded_time] * len(user[InMemoryServerDAO.MESSAGES_NAME])
+    user[InMemoryServerDAO.MESSAGE_BYTES_NAME] = sum(len(message) for message in user[InMemoryServerDAO.MESSAGES_NAME])
+    return user
+
+
+def decode_stored_users(users):
+    loaded_time = time.time()
+    for user in users.values():
+        decode_stored_user(user, loaded_time)
+    return users
+
+
+def read_stored_users(storage_file):
+    loaded_time = time.time()
+    users = {}
+    for line in iter(storage_file.readline, b""):
+        if len(line.strip()) == 0:
+            continue
+        record = serialization.loads(line)
+        if isinstance(record.get(InMemoryServerDAO.USERNAME_NAME), str):
+            users[record[InMemoryServerDAO.USERNAME_NAME]] = decode_stored_user(record, loaded_time, storage_file)
+        else:
+            users.update(decode_stored_users(record))
+    return users
+
+
+def write_stored_users(users):
+    return b"".join(dumps_stored_record(user) for user in users.values())
 
 
 class ServerDAO(ABC):
+    def __init__(self):
+        self.lock = threading.RLock()
+
+    def lock_for(self, username):
+        return self.lock
+
+    def close(self):
+        pass
+
+    def advance_user_auth_time(self, username, date_time):
+        if date_time <= self.get_user_info(username)[InMemoryServerDAO.LAST_DATE_TIME_NAME]:
+            return False
+        self.update_user_auth_time(username, date_time)
+        return True
+
     @abstractmethod
     def create_user(self, username, public_key, time):
         pass
@@ -21,6 +118,14 @@ class ServerDAO(ABC):
     def get_user_pending_messages(self, username):
         pass
 
+    @abstractmethod
+    def get_user_pending_messages_page(self, username, cursor, limit):
+        pass
+
+    @abstractmethod
+    def ack_user_pending_messages(self, username, cursor):
+        pass
+
     @abstractmethod
     def clear_user_pending_messages(self, username):
         pass
@@ -29,6 +134,18 @@ class ServerDAO(ABC):
     def save_user_message(self, recipient, message):
         pass
 
+    @abstractmethod
+    def save_user_messages(self, messages):
+        pass
+
+    @abstractmethod
+    def get_user_mailbox_usage(self, username):
+        pass
+
+    @abstractmethod
+    def expire_pending_messages(self, sent_before):
+        pass
+
 
 class InMemoryServerDAO(ServerDAO):
     PUBLIC_KEY_NAME = "public_key"
@@ -36,8 +153,12 @@ class InMemoryServerDAO(ServerDAO):
     LAST_DATE_TIME_NAME = "last_date_time"
 
     MESSAGES_NAME = "messages"
+    MESSAGE_OFFSET_NAME = "message_offset"
+    MESSAGE_TIMES_NAME = "message_times"
+    MESSAGE_BYTES_NAME = "message_bytes"
 
     def __init__(self):
+        super().__init__()
         self.users = {}
 
     def create_user(self, username, public_key, time):
@@ -48,6 +169,9 @@ class InMemoryServerDAO(ServerDAO):
                 self.USERNAME_NAME: username,
                 self.PUBLIC_KEY_NAME: public_key,
                 self.MESSAGES_NAME: [],
+                self.MESSAGE_OFFSET_NAME: 0,
+                self.MESSAGE_TIMES_NAME: [],
+                self.MESSAGE_BYTES_NAME: 0,
                 self.LAST_DATE_TIME_NAME: time,
             }
             return True
@@ -79,54 +203,682 @@ class InMemoryServerDAO(ServerDAO):
         else:
             return []
 
+    def get_user_pending_messages_page(self, username, cursor, limit):
+        if username in self.users:
+            user = self.users[username]
+            offset = user.get(self.MESSAGE_OFFSET_NAME, 0)
+            start = max(cursor, offset) - offset
+            end = len(user[self.MESSAGES_NAME]) if limit is None else start + limit
+            page = user[self.MESSAGES_NAME][start:end]
+            return (page, offset + start + len(page))
+        else:
+            return ([], cursor)
+
+    def ack_user_pending_messages(self, username, cursor):
+        if username in self.users:
+            user = self.users[username]
+            offset = user.get(self.MESSAGE_OFFSET_NAME, 0)
+            acknowledged = min(max(cursor - offset, 0), len(user[self.MESSAGES_NAME]))
+            if acknowledged > 0:
+                user[self.MESSAGE_BYTES_NAME] -= sum(len(message) for message in user[self.MESSAGES_NAME][:acknowledged])
+                user[self.MESSAGES_NAME] = user[self.MESSAGES_NAME][acknowledged:]
+                user[self.MESSAGE_TIMES_NAME] = user[self.MESSAGE_TIMES_NAME][acknowledged:]
+                user[self.MESSAGE_OFFSET_NAME] = offset + acknowledged
+            return acknowledged
+        else:
+            return 0
+
     def clear_user_pending_messages(self, username):
         if username in self.users:
-            self.users[username][self.MESSAGES_NAME] = []
+            user = self.users[username]
+            user[self.MESSAGE_OFFSET_NAME] = user.get(self.MESSAGE_OFFSET_NAME, 0) + len(user[self.MESSAGES_NAME])
+            user[self.MESSAGES_NAME] = []
+            user[self.MESSAGE_TIMES_NAME] = []
+            user[self.MESSAGE_BYTES_NAME] = 0
 
-    def save_user_message(self, recipient, message):
+    def save_user_message(self, recipient, message, sent_time=None):
         if recipient in self.users:
-            self.users[recipient][self.MESSAGES_NAME].append(message)
+            user = self.users[recipient]
+            user[self.MESSAGES_NAME].append(message)
+            user[self.MESSAGE_TIMES_NAME].append(time.time() if sent_time is None else sent_time)
+            user[self.MESSAGE_BYTES_NAME] += len(message)
+
+    def save_user_messages(self, messages):
+        for (recipient, message) in messages:
+            self.save_user_message(recipient, message)
+
+    def get_user_mailbox_usage(self, username):
+        if username in self.users:
+            user = self.users[username]
+            return (len(user[self.MESSAGES_NAME]), user[self.MESSAGE_BYTES_NAME])
+        else:
+            return (0, 0)
+
+    def get_expiry_cursor(self, username, sent_before):
+        user = self.users[username]
+        return user.get(self.MESSAGE_OFFSET_NAME, 0) + bisect.bisect_left(user[self.MESSAGE_TIMES_NAME], sent_before)
+
+    def expire_pending_messages(self, sent_before):
+        with self.lock:
+            return sum(self.ack_user_pending_messages(username, self.get_expiry_cursor(username, sent_before))
+                       for username in list(self.users))
 
 
 class FileBasedServerDAO(ServerDAO):
     STORAGE_FOLDER = "server_data"
     STORAGE_FILE = "server_data.json"
+    FLUSH_BATCH_SIZE = 1000
 
-    def __init__(self):
+    def __init__(self, storage_folder=STORAGE_FOLDER, flush_interval=None, flush_batch_size=FLUSH_BATCH_SIZE):
+        super().__init__()
         self.in_memory = InMemoryServerDAO()
-        try:
-            os.mkdir(self.STORAGE_FOLDER)
-        except FileExistsError:
-            self.__load_data()
-            self.__save_data()
+        self.storage_folder = storage_folder
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self.pending_writes = 0
+        self.write_lock = threading.Lock()
+        self.flush_requested = threading.Event()
+        self.stopped = threading.Event()
+        self.flusher = None
+        self.loaded = threading.Event()
+        self.load_error = None
+        os.makedirs(self.storage_folder, exist_ok=True)
+        self.loader = threading.Thread(target=self.__load_data, daemon=True)
+        self.loader.start()
+        if self.flush_interval is not None:
+            self.flusher = threading.Thread(target=self.__flush_periodically, daemon=True)
+            self.flusher.start()
+
+    def __storage_path(self):
+        return os.path.join(self.storage_folder, self.STORAGE_FILE)
 
     def __load_data(self):
-        with open(os.path.join(self.STORAGE_FOLDER, self.STORAGE_FILE), "r", encoding="utf-8") as storage_file:
-            self.in_memory.users = json.loads(storage_file.read())
+        try:
+            with open(self.__storage_path(), "rb") as storage_file:
+                self.in_memory.users = read_stored_users(storage_file)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error("Loading server data failed", exc_info=True)
+            self.load_error = e
+        finally:
+            self.loaded.set()
+
+    def wait_until_loaded(self):
+        self.loaded.wait()
+        if self.load_error is not None:
+            raise RuntimeError("Server data could not be loaded") from self.load_error
 
     def __save_data(self):
-        with open(os.path.join(self.STORAGE_FOLDER, self.STORAGE_FILE), "w+", encoding="utf-8") as storage_file:
-            storage_file.write(json.dumps(self.in_memory.users))
+        with self.lock:
+            self.pending_writes += 1
+            if self.flusher is None:
+                self.flush()
+            elif self.pending_writes >= self.flush_batch_size:
+                self.flush_requested.set()
+
+    def __flush_periodically(self):
+        while not self.stopped.is_set():
+            self.flush_requested.wait(self.flush_interval)
+            self.flush_requested.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.warning("Flushing server data failed", exc_info=True)
+
+    def flush(self):
+        with self.lock:
+            pending_writes = self.pending_writes
+            if pending_writes == 0:
+                return
+            self.pending_writes = 0
+            with timed_stage("dao_serialize"):
+                contents = write_stored_users(self.in_memory.users)
+            # Taken before the data lock is released so snapshots reach the disk in the order they were serialized.
+            self.write_lock.acquire()
+        try:
+            self.__write_atomically(contents)
+        except Exception:
+            self.write_lock.release()
+            with self.lock:
+                self.pending_writes += pending_writes
+            raise
+        self.write_lock.release()
+
+    def __write_atomically(self, contents):
+        temp_path = self.__storage_path() + ".tmp"
+        with open(temp_path, "wb") as storage_file:
+            with timed_stage("dao_write"):
+                storage_file.write(contents)
+                storage_file.flush()
+            with timed_stage("dao_fsync"):
+                os.fsync(storage_file.fileno())
+        os.replace(temp_path, self.__storage_path())
+
+    def close(self):
+        if self.flusher is not None:
+            self.stopped.set()
+            self.flush_requested.set()
+            self.flusher.join()
+        self.flush()
 
     def create_user(self, username, public_key, time):
+        self.wait_until_loaded()
         result = self.in_memory.create_user(username, public_key, time)
         self.__save_data()
         return result
 
     def get_user_info(self, username):
+        self.wait_until_loaded()
         return self.in_memory.get_user_info(username)
 
     def update_user_auth_time(self, username, date_time):
+        self.wait_until_loaded()
         self.in_memory.update_user_auth_time(username, date_time)
         self.__save_data()
 
     def get_user_pending_messages(self, username):
+        self.wait_until_loaded()
         return self.in_memory.get_user_pending_messages(username)
 
+    def get_user_pending_messages_page(self, username, cursor, limit):
+        self.wait_until_loaded()
+        return self.in_memory.get_user_pending_messages_page(username, cursor, limit)
+
+    def ack_user_pending_messages(self, username, cursor):
+        self.wait_until_loaded()
+        acknowledged = self.in_memory.ack_user_pending_messages(username, cursor)
+        if acknowledged > 0:
+            self.__save_data()
+        return acknowledged
+
     def clear_user_pending_messages(self, username):
+        self.wait_until_loaded()
         self.in_memory.clear_user_pending_messages(username)
         self.__save_data()
 
     def save_user_message(self, recipient, message):
+        self.wait_until_loaded()
         self.in_memory.save_user_message(recipient, message)
         self.__save_data()
+
+    def save_user_messages(self, messages):
+        self.wait_until_loaded()
+        self.in_memory.save_user_messages(messages)
+        self.__save_data()
+
+    def get_user_mailbox_usage(self, username):
+        self.wait_until_loaded()
+        return self.in_memory.get_user_mailbox_usage(username)
+
+    def expire_pending_messages(self, sent_before):
+        self.wait_until_loaded()
+        with self.lock:
+            expired = self.in_memory.expire_pending_messages(sent_before)
+            if expired > 0:
+                self.__save_data()
+        return expired
+
+
+class LogBasedServerDAO(ServerDAO):
+    STORAGE_FOLDER = "server_data"
+    LEGACY_STORAGE_FILE = "server_data.json"
+    SNAPSHOT_FILE = "server_snapshot.json"
+    LOG_FILE_PREFIX = "server_log."
+    COMPACTION_THRESHOLD = 10000
+
+    GENERATION_NAME = "generation"
+    USERS_NAME = "users"
+    OPERATION_NAME = "op"
+
+    CREATE_USER_OPERATION = "create_user"
+    UPDATE_AUTH_TIME_OPERATION = "update_user_auth_time"
+    SAVE_MESSAGE_OPERATION = "save_user_message"
+    CLEAR_MESSAGES_OPERATION = "clear_user_pending_messages"
+    ACK_MESSAGES_OPERATION = "ack_user_pending_messages"
+
+    def __init__(self, storage_folder=STORAGE_FOLDER, compaction_threshold=COMPACTION_THRESHOLD):
+        super().__init__()
+        self.in_memory = InMemoryServerDAO()
+        self.storage_folder = storage_folder
+        self.compaction_threshold = compaction_threshold
+        self.generation = 0
+        self.log_entries = 0
+        os.makedirs(self.storage_folder, exist_ok=True)
+        self.__load_snapshot()
+        self.__remove_stale_logs()
+        self.__replay_log()
+        self.log_file = open(self.__log_path(self.generation), "ab")
+
+    def __snapshot_path(self):
+        return os.path.join(self.storage_folder, self.SNAPSHOT_FILE)
+
+    def __log_path(self, generation):
+        return os.path.join(self.storage_folder, self.LOG_FILE_PREFIX + str(generation))
+
+    def __load_snapshot(self):
+        try:
+            with open(self.__snapshot_path(), "rb") as snapshot_file:
+                header = serialization.loads(snapshot_file.readline())
+                self.generation = header[self.GENERATION_NAME]
+                if self.USERS_NAME in header:
+                    self.in_memory.users = decode_stored_users(header[self.USERS_NAME])
+                else:
+                    self.in_memory.users = read_stored_users(snapshot_file)
+        except FileNotFoundError:
+            self.__load_legacy_storage()
+
+    def __load_legacy_storage(self):
+        try:
+            with open(os.path.join(self.storage_folder, self.LEGACY_STORAGE_FILE), "rb") as storage_file:
+                self.in_memory.users = read_stored_users(storage_file)
+        except FileNotFoundError:
+            pass
+
+    def __remove_stale_logs(self):
+        for file_name in os.listdir(self.storage_folder):
+            if file_name.startswith(self.LOG_FILE_PREFIX) and file_name != self.LOG_FILE_PREFIX + str(self.generation):
+                os.remove(os.path.join(self.storage_folder, file_name))
+
+    def __replay_log(self):
+        valid_length = 0
+        try:
+            with open(self.__log_path(self.generation), "rb") as log_file:
+                for line in iter(log_file.readline, b""):
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = serialization.loads(line)
+                        if "message" in record:
+                            record["message"] = decode_stored_message(record["message"], log_file)
+                    except (ValueError, EOFError):
+                        break
+                    self.__apply(record)
+                    self.log_entries += 1
+                    valid_length = log_file.tell()
+            os.truncate(self.__log_path(self.generation), valid_length)
+        except FileNotFoundError:
+            pass
+
+    def __apply(self, record):
+        operation = record[self.OPERATION_NAME]
+        if operation == self.CREATE_USER_OPERATION:
+            self.in_memory.create_user(record["username"], record["public_key"], record["time"])
+        elif operation == self.UPDATE_AUTH_TIME_OPERATION:
+            self.in_memory.update_user_auth_time(record["username"], datetime.fromisoformat(record["time"]))
+        elif operation == self.SAVE_MESSAGE_OPERATION:
+            self.in_memory.save_user_message(record["recipient"], decode_stored_message(record["message"]), record.get("sent_time"))
+        elif operation == self.CLEAR_MESSAGES_OPERATION:
+            self.in_memory.clear_user_pending_messages(record["username"])
+        elif operation == self.ACK_MESSAGES_OPERATION:
+            self.in_memory.ack_user_pending_messages(record["username"], record["cursor"])
+
+    def __append(self, record):
+        self.__append_all([record])
+
+    def __append_all(self, records):
+        with timed_stage("dao_serialize"):
+            contents = b"".join(dumps_stored_record(record) for record in records)
+        with timed_stage("dao_write"):
+            self.log_file.write(contents)
+            self.log_file.flush()
+        self.log_entries += len(records)
+        if self.log_entries >= self.compaction_threshold:
+            self.compact()
+
+    def compact(self):
+        next_generation = self.generation + 1
+        temp_path = self.__snapshot_path() + ".tmp"
+        with timed_stage("dao_compact_serialize"):
+            contents = serialization.dumps_bytes({self.GENERATION_NAME: next_generation}) + b"\n" + write_stored_users(self.in_memory.users)
+        with open(temp_path, "wb") as snapshot_file:
+            with timed_stage("dao_compact_write"):
+                snapshot_file.write(contents)
+                snapshot_file.flush()
+            with timed_stage("dao_fsync"):
+                os.fsync(snapshot_file.fileno())
+        os.replace(temp_path, self.__snapshot_path())
+        self.log_file.close()
+        os.remove(self.__log_path(self.generation))
+        self.generation = next_generation
+        self.log_file = open(self.__log_path(self.generation), "ab")
+        self.log_entries = 0
+
+    def close(self):
+        self.log_file.close()
+
+    def create_user(self, username, public_key, time):
+        result = self.in_memory.create_user(username, public_key, time)
+        if result:
+            self.__append({self.OPERATION_NAME: self.CREATE_USER_OPERATION,
+                           "username": username, "public_key": public_key, "time": time})
+        return result
+
+    def get_user_info(self, username):
+        return self.in_memory.get_user_info(username)
+
+    def update_user_auth_time(self, username, date_time):
+        if username in self.in_memory.users:
+            self.in_memory.update_user_auth_time(username, date_time)
+            self.__append({self.OPERATION_NAME: self.UPDATE_AUTH_TIME_OPERATION,
+                           "username": username, "time": date_time.isoformat()})
+
+    def get_user_pending_messages(self, username):
+        return self.in_memory.get_user_pending_messages(username)
+
+    def get_user_pending_messages_page(self, username, cursor, limit):
+        return self.in_memory.get_user_pending_messages_page(username, cursor, limit)
+
+    def ack_user_pending_messages(self, username, cursor):
+        acknowledged = self.in_memory.ack_user_pending_messages(username, cursor)
+        if acknowledged > 0:
+            self.__append({self.OPERATION_NAME: self.ACK_MESSAGES_OPERATION, "username": username, "cursor": cursor})
+        return acknowledged
+
+    def clear_user_pending_messages(self, username):
+        if username in self.in_memory.users:
+            self.in_memory.clear_user_pending_messages(username)
+            self.__append({self.OPERATION_NAME: self.CLEAR_MESSAGES_OPERATION, "username": username})
+
+    def save_user_message(self, recipient, message):
+        self.save_user_messages([(recipient, message)])
+
+    def save_user_messages(self, messages):
+        sent_time = time.time()
+        records = []
+        for (recipient, message) in messages:
+            if recipient in self.in_memory.users:
+                self.in_memory.save_user_message(recipient, message, sent_time)
+                records.append({self.OPERATION_NAME: self.SAVE_MESSAGE_OPERATION,
+                                "recipient": recipient, "message": message, "sent_time": sent_time})
+        if len(records) > 0:
+            self.__append_all(records)
+
+    def get_user_mailbox_usage(self, username):
+        return self.in_memory.get_user_mailbox_usage(username)
+
+    def expire_pending_messages(self, sent_before):
+        with self.lock:
+            return sum(self.ack_user_pending_messages(username, self.in_memory.get_expiry_cursor(username, sent_before))
+                       for username in list(self.in_memory.users))
+
+
+class SqliteServerDAO(ServerDAO):
+    STORAGE_FOLDER = "server_data"
+    DATABASE_FILE = "server_data.db"
+    BUSY_TIMEOUT = 30
+
+    def __init__(self, storage_folder=STORAGE_FOLDER):
+        super().__init__()
+        os.makedirs(storage_folder, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(storage_folder, self.DATABASE_FILE),
+                                          timeout=self.BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, public_key TEXT NOT NULL, last_date_time TEXT NOT NULL)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, recipient TEXT NOT NULL, message BLOB NOT NULL)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS messages_recipient ON messages (recipient, id)")
+        self.__migrate_schema()
+
+    def __migrate_schema(self):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                if self.connection.execute("PRAGMA user_version").fetchone()[0] < 1:
+                    self.connection.execute("ALTER TABLE messages ADD COLUMN sent_time REAL")
+                    self.connection.execute("UPDATE messages SET sent_time = ?", (time.time(),))
+                    self.connection.execute("CREATE INDEX messages_sent_time ON messages (sent_time)")
+                    self.connection.execute("PRAGMA user_version = 1")
+                if self.connection.execute("PRAGMA user_version").fetchone()[0] < 2:
+                    self.connection.execute("ALTER TABLE users ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0")
+                    self.connection.execute("ALTER TABLE users ADD COLUMN message_bytes INTEGER NOT NULL DEFAULT 0")
+                    self.connection.execute(
+                        "UPDATE users SET message_count = (SELECT COUNT(*) FROM messages WHERE recipient = username), "
+                        "message_bytes = (SELECT COALESCE(SUM(LENGTH(CAST(message AS BLOB))), 0) FROM messages WHERE recipient = username)")
+                    self.connection.execute(
+                        "CREATE TRIGGER messages_count_insert AFTER INSERT ON messages BEGIN "
+                        "UPDATE users SET message_count = message_count + 1, message_bytes = message_bytes + LENGTH(CAST(NEW.message AS BLOB)) "
+                        "WHERE username = NEW.recipient; END")
+                    self.connection.execute(
+                        "CREATE TRIGGER messages_count_delete AFTER DELETE ON messages BEGIN "
+                        "UPDATE users SET message_count = message_count - 1, message_bytes = message_bytes - LENGTH(CAST(OLD.message AS BLOB)) "
+                        "WHERE username = OLD.recipient; END")
+                    self.connection.execute("PRAGMA user_version = 2")
+                self.connection.execute("COMMIT")
+            except sqlite3.Error:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        self.connection.close()
+
+    def create_user(self, username, public_key, time):
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO users (username, public_key, last_date_time) VALUES (?, ?, ?)", (username, public_key, time))
+            return cursor.rowcount == 1
+
+    def get_user_info(self, username):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT username, public_key, last_date_time FROM users WHERE username = ?", (username,)).fetchone()
+        if row is None:
+            return {
+                InMemoryServerDAO.USERNAME_NAME: "",
+                InMemoryServerDAO.PUBLIC_KEY_NAME: "",
+                InMemoryServerDAO.MESSAGES_NAME: [],
+                InMemoryServerDAO.LAST_DATE_TIME_NAME: datetime.min,
+            }
+        return {
+            InMemoryServerDAO.USERNAME_NAME: row[0],
+            InMemoryServerDAO.PUBLIC_KEY_NAME: row[1],
+            InMemoryServerDAO.MESSAGES_NAME: [],
+            InMemoryServerDAO.LAST_DATE_TIME_NAME: datetime.fromisoformat(row[2]),
+        }
+
+    def update_user_auth_time(self, username, date_time):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE users SET last_date_time = ? WHERE username = ?", (date_time.isoformat(), username))
+
+    def advance_user_auth_time(self, username, date_time):
+        with self.lock:
+            return self.connection.execute(
+                "UPDATE users SET last_date_time = ? WHERE username = ? AND last_date_time < ?",
+                (date_time.isoformat(), username, date_time.isoformat())).rowcount == 1
+
+    def get_user_pending_messages(self, username):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT message FROM messages WHERE recipient = ? ORDER BY id", (username,)).fetchall()
+        return [row[0] for row in rows]
+
+    def get_user_pending_messages_page(self, username, cursor, limit):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, message FROM messages WHERE recipient = ? AND id >= ? ORDER BY id LIMIT ?",
+                (username, cursor, -1 if limit is None else limit)).fetchall()
+        if len(rows) == 0:
+            return ([], cursor)
+        return ([row[1] for row in rows], rows[-1][0] + 1)
+
+    def ack_user_pending_messages(self, username, cursor):
+        with self.lock, timed_stage("dao_write"):
+            return self.connection.execute(
+                "DELETE FROM messages WHERE recipient = ? AND id < ?", (username, cursor)).rowcount
+
+    def clear_user_pending_messages(self, username):
+        with self.lock:
+            self.connection.execute("DELETE FROM messages WHERE recipient = ?", (username,))
+
+    def save_user_message(self, recipient, message):
+        with self.lock, timed_stage("dao_write"):
+            self.connection.execute(
+                "INSERT INTO messages (recipient, message, sent_time) SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM users WHERE username = ?)",
+                (recipient, message, time.time(), recipient))
+
+    def save_user_messages(self, messages):
+        with self.lock, timed_stage("dao_write"):
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                sent_time = time.time()
+                self.connection.executemany(
+                    "INSERT INTO messages (recipient, message, sent_time) SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM users WHERE username = ?)",
+                    [(recipient, message, sent_time, recipient) for (recipient, message) in messages])
+                self.connection.execute("COMMIT")
+            except sqlite3.Error:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def get_user_mailbox_usage(self, username):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT message_count, message_bytes FROM users WHERE username = ?", (username,)).fetchone()
+        return (0, 0) if row is None else tuple(row)
+
+    def expire_pending_messages(self, sent_before):
+        with self.lock:
+            return self.connection.execute("DELETE FROM messages WHERE sent_time < ?", (sent_before,)).rowcount
+
+    def get_last_message_id(self):
+        with self.lock:
+            return self.connection.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+
+    def get_message_recipients_since(self, message_id):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT recipient, MAX(id) FROM messages WHERE id > ? GROUP BY recipient", (message_id,)).fetchall()
+        return ([row[0] for row in rows], max([message_id] + [row[1] for row in rows]))
+
+
+class ShardedServerDAO(ServerDAO):
+    STORAGE_FOLDER = "server_data"
+    SHARDS_FILE = "shards.json"
+    SHARD_FOLDER_PREFIX = "shard_"
+    SHARD_COUNT = 16
+
+    SHARD_COUNT_NAME = "shard_count"
+
+    def __init__(self, storage_folder=STORAGE_FOLDER, shard_count=SHARD_COUNT, compaction_threshold=LogBasedServerDAO.COMPACTION_THRESHOLD):
+        super().__init__()
+        self.storage_folder = storage_folder
+        os.makedirs(self.storage_folder, exist_ok=True)
+        stored_shard_count = self.__load_shard_count()
+        self.shard_count = stored_shard_count if stored_shard_count is not None else shard_count
+        self.shards = [LogBasedServerDAO(os.path.join(self.storage_folder, self.SHARD_FOLDER_PREFIX + str(i)), compaction_threshold)
+                       for i in range(self.shard_count)]
+        if stored_shard_count is None:
+            self.__import_unsharded_storage()
+            self.__save_shard_count()
+            self.__remove_unsharded_storage()
+
+    def __shards_path(self):
+        return os.path.join(self.storage_folder, self.SHARDS_FILE)
+
+    def __load_shard_count(self):
+        try:
+            with open(self.__shards_path(), "r", encoding="utf-8") as shards_file:
+                return serialization.loads(shards_file.read())[self.SHARD_COUNT_NAME]
+        except FileNotFoundError:
+            return None
+
+    def __save_shard_count(self):
+        temp_path = self.__shards_path() + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as shards_file:
+            shards_file.write(serialization.dumps({self.SHARD_COUNT_NAME: self.shard_count}))
+            shards_file.flush()
+            os.fsync(shards_file.fileno())
+        os.replace(temp_path, self.__shards_path())
+
+    def __unsharded_storage_paths(self):
+        return [os.path.join(self.storage_folder, file_name) for file_name in os.listdir(self.storage_folder)
+                if file_name in (LogBasedServerDAO.SNAPSHOT_FILE, LogBasedServerDAO.LEGACY_STORAGE_FILE)
+                or file_name.startswith(LogBasedServerDAO.LOG_FILE_PREFIX)]
+
+    def __import_unsharded_storage(self):
+        if len(self.__unsharded_storage_paths()) == 0:
+            return
+        unsharded = LogBasedServerDAO(self.storage_folder)
+        unsharded.close()
+        for (username, user) in unsharded.in_memory.users.items():
+            self.shard_for(username).in_memory.users[username] = user
+        for shard in self.shards:
+            shard.compact()
+
+    def __remove_unsharded_storage(self):
+        for path in self.__unsharded_storage_paths():
+            os.remove(path)
+
+    def shard_for(self, username):
+        return self.shards[zlib.crc32(username.encode('utf-8')) % self.shard_count]
+
+    def lock_for(self, username):
+        return self.shard_for(username).lock
+
+    def close(self):
+        for shard in self.shards:
+            with shard.lock:
+                shard.close()
+
+    def create_user(self, username, public_key, time):
+        shard = self.shard_for(username)
+        with shard.lock:
+            return shard.create_user(username, public_key, time)
+
+    def get_user_info(self, username):
+        shard = self.shard_for(username)
+        with shard.lock:
+            return shard.get_user_info(username)
+
+    def update_user_auth_time(self, username, date_time):
+        shard = self.shard_for(username)
+        with shard.lock:
+            shard.update_user_auth_time(username, date_time)
+
+    def get_user_pending_messages(self, username):
+        shard = self.shard_for(username)
+        with shard.lock:
+            return shard.get_user_pending_messages(username)
+
+    def get_user_pending_messages_page(self, username, cursor, limit):
+        shard = self.shard_for(username)
+        with shard.lock:
+            return shard.get_user_pending_messages_page(username, cursor, limit)
+
+    def ack_user_pending_messages(self, username, cursor):
+        shard = self.shard_for(username)
+        with shard.lock:
+            return shard.ack_user_pending_messages(username, cursor)
+
+    def clear_user_pending_messages(self, username):
+        shard = self.shard_for(username)
+        with shard.lock:
+            shard.clear_user_pending_messages(username)
+
+    def save_user_message(self, recipient, message):
+        shard = self.shard_for(recipient)
+        with shard.lock:
+            shard.save_user_message(recipient, message)
+
+    def get_user_mailbox_usage(self, username):
+        shard = self.shard_for(username)
+        with shard.lock:
+            return shard.get_user_mailbox_usage(username)
+
+    def expire_pending_messages(self, sent_before):
+        expired = 0
+        for shard in self.shards:
+            with shard.lock:
+                expired += shard.expire_pending_messages(sent_before)
+        return expired
+
+    def save_user_messages(self, messages):
+        shard_messages = {}
+        for (recipient, message) in messages:
+            shard_messages.setdefault(id(self.shard_for(recipient)), (self.shard_for(recipient), []))[1].append((recipient, message))
+        for (shard, messages_for_shard) in shard_messages.values():
+            with shard.lock:
+                shard.save_user_messages(messages_for_shard)
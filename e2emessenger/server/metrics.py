@@ -0,0 +1,158 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def format_labels(label_names, label_values):
+    if len(label_names) == 0:
+        return ""
+    return "{" + ",".join(name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+                          for (name, value) in zip(label_names, label_values)) + "}"
+
+
+class Counter():
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = list(self.values.items())
+        return ["# HELP " + self.name + " " + self.description, "# TYPE " + self.name + " counter"] + \
+            [self.name + format_labels(self.label_names, label_values) + " " + format_value(value) for (label_values, value) in values]
+
+
+class Histogram():
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if label_values not in self.values:
+                self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            series = self.values[label_values]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self):
+        with self.lock:
+            values = [(label_values, list(series[0]), series[1], series[2]) for (label_values, series) in self.values.items()]
+        lines = ["# HELP " + self.name + " " + self.description, "# TYPE " + self.name + " histogram"]
+        for (label_values, bucket_counts, total, count) in values:
+            cumulative = 0
+            for (bucket, bucket_count) in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(self.name + "_bucket" + format_labels(self.label_names + ("le",), label_values + (format_value(bucket),)) +
+                             " " + format_value(cumulative))
+            lines.append(self.name + "_sum" + format_labels(self.label_names, label_values) + " " + format_value(total))
+            lines.append(self.name + "_count" + format_labels(self.label_names, label_values) + " " + format_value(count))
+        return lines
+
+
+class MetricsRegistry():
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, description, label_names=()):
+        metric = Counter(name, description, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, description, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            for (name, metric_type, description, samples) in collector():
+                lines.extend(["# HELP " + name + " " + description, "# TYPE " + name + " " + metric_type])
+                lines.extend(name + format_labels(tuple(labels), tuple(labels.values())) + " " + format_value(value)
+                             for (labels, value) in samples)
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+http_requests = registry.counter("e2e_http_requests_total", "HTTP requests by method, route and status code.",
+                                 ("method", "route", "status"))
+http_request_duration = registry.histogram("e2e_http_request_duration_seconds", "HTTP request latency by method and route.",
+                                           ("method", "route"))
+stage_duration = registry.histogram("e2e_stage_duration_seconds", "Time spent in internal server stages.", ("stage",))
+mailbox_messages = registry.histogram("e2e_mailbox_messages", "Pending messages in a recipient's mailbox when a message is sent to it.",
+                                      buckets=SIZE_BUCKETS)
+
+
+def timed_stage(stage):
+    return stage_duration.time(stage)
+
+
+class MetricsMiddleware():
+    def __init__(self, app):
+        self.app = app
+        self.route_paths = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status_code[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = self.__route_path(scope)
+            http_requests.inc(scope["method"], route, str(status_code[0]))
+            http_request_duration.observe(time.perf_counter() - start, scope["method"], route)
+
+    def __route_path(self, scope):
+        if self.route_paths is None and "app" in scope:
+            self.route_paths = {route.endpoint: route.path for route in scope["app"].routes if hasattr(route, "endpoint")}
+        return (self.route_paths or {}).get(scope.get("endpoint"), "other")
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class MessageNotifier():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = {}
+
+    def subscribe(self, username):
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        with self.lock:
+            self.waiters.setdefault(username, []).append(waiter)
+        return waiter
+
+    def unsubscribe(self, username, waiter):
+        with self.lock:
+            if username in self.waiters:
+                if waiter in self.waiters[username]:
+                    self.waiters[username].remove(waiter)
+                if len(self.waiters[username]) == 0:
+                    del self.waiters[username]
+
+    async def wait(self, waiter, timeout):
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def notify(self, username):
+        with self.lock:
+            waiters = self.waiters.pop(username, [])
+        for (loop, future) in waiters:
+            loop.call_soon_threadsafe(self.__wake, future)
+
+    def __wake(self, future):
+        if not future.done():
+            future.set_result(True)
+
+    def close(self):
+        pass
+
+
+class PollingMessageNotifier(MessageNotifier):
+    POLL_INTERVAL = 0.25
+
+    def __init__(self, dao, poll_interval=POLL_INTERVAL):
+        super().__init__()
+        self.dao = dao
+        self.poll_interval = poll_interval
+        self.last_message_id = dao.get_last_message_id()
+        self.stopped = threading.Event()
+        self.poller = threading.Thread(target=self.__poll, daemon=True)
+        self.poller.start()
+
+    def __poll(self):
+        while not self.stopped.wait(self.poll_interval):
+            try:
+                (recipients, self.last_message_id) = self.dao.get_message_recipients_since(self.last_message_id)
+            except Exception:
+                logger.warning("Polling for new messages failed", exc_info=True)
+                continue
+            for recipient in recipients:
+                self.notify(recipient)
+
+    def close(self):
+        self.stopped.set()
+        self.poller.join()
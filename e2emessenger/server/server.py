@@ -1,7 +1,19 @@
-from fastapi import FastAPI, Response, status
+import os
+import base64
+import asyncio
+from datetime import timedelta
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, Header, Request, Response, status
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
+from ..crypto import crypto
+from ..serialization import serialization
 from .service import ServerServices
-from .dao import FileBasedServerDAO
+from .dao import InMemoryServerDAO, FileBasedServerDAO, LogBasedServerDAO, ShardedServerDAO, SqliteServerDAO
+from .notifier import MessageNotifier, PollingMessageNotifier
+from .sweeper import MessageSweeper
+from . import metrics
 
 
 class RegisterInfo(BaseModel):
@@ -12,8 +24,9 @@ class RegisterInfo(BaseModel):
 
 class AuthInfo(BaseModel):
     username: str
-    time: str
-    signature: str
+    time: str = ""
+    signature: str = ""
+    token: str = ""
 
 
 class SendMessageInfo(BaseModel):
@@ -22,10 +35,134 @@ class SendMessageInfo(BaseModel):
     message: str
 
 
-dao = FileBasedServerDAO()
-service = ServerServices(dao)
+class BatchMessageInfo(BaseModel):
+    recipient: str
+    message: str
+
+
+class SendBatchMessageInfo(BaseModel):
+    auth: AuthInfo
+    messages: List[BatchMessageInfo]
+
+
+class AckMessagesInfo(BaseModel):
+    auth: AuthInfo
+    cursor: int
+
+
+class SerializedJSONResponse(JSONResponse):
+    def render(self, content):
+        return serialization.dumps_bytes(content)
+
+
+WORKER_THREADS = int(os.environ.get("E2E_SERVER_THREADS", os.cpu_count() or 1))
+MAX_WAIT_TIMEOUT = 60
+MAX_PULL_LIMIT = 1000
+STORAGE_FOLDER = "server_data"
+STORAGE_BACKEND = os.environ.get("E2E_SERVER_STORAGE", "sharded")
+SERVER_WORKERS = int(os.environ.get("E2E_SERVER_WORKERS", 1))
+STORAGE_SHARDS = int(os.environ.get("E2E_SERVER_SHARDS", ShardedServerDAO.SHARD_COUNT))
+SESSION_SECRET = os.environ.get("E2E_SESSION_SECRET", "")
+SESSION_SECRET_FILE = "session_secret"
+MAILBOX_MAX_MESSAGES = int(os.environ.get("E2E_MAILBOX_MAX_MESSAGES", 10000))
+MAILBOX_MAX_BYTES = int(os.environ.get("E2E_MAILBOX_MAX_BYTES", 64 * 1024 * 1024))
+MESSAGE_TTL_DAYS = float(os.environ.get("E2E_MESSAGE_TTL_DAYS", 30))
+SWEEP_INTERVAL = float(os.environ.get("E2E_SWEEP_INTERVAL", MessageSweeper.SWEEP_INTERVAL))
+FILE_FLUSH_INTERVAL = float(os.environ.get("E2E_FILE_FLUSH_INTERVAL", 1))
+FILE_FLUSH_BATCH_SIZE = int(os.environ.get("E2E_FILE_FLUSH_BATCH_SIZE", FileBasedServerDAO.FLUSH_BATCH_SIZE))
+
+
+def create_storage(backend):
+    if SERVER_WORKERS > 1 and backend != "sqlite":
+        raise ValueError("Storage backend " + backend + " can't be shared by " + str(SERVER_WORKERS) + " server processes, use sqlite")
+    if backend == "sharded":
+        return (ShardedServerDAO(STORAGE_FOLDER, shard_count=STORAGE_SHARDS), MessageNotifier())
+    elif backend == "sqlite":
+        sqlite_dao = SqliteServerDAO(STORAGE_FOLDER)
+        return (sqlite_dao, PollingMessageNotifier(sqlite_dao))
+    elif backend == "log":
+        return (LogBasedServerDAO(STORAGE_FOLDER), MessageNotifier())
+    elif backend == "file":
+        return (FileBasedServerDAO(STORAGE_FOLDER, flush_interval=FILE_FLUSH_INTERVAL if FILE_FLUSH_INTERVAL > 0 else None,
+                                   flush_batch_size=FILE_FLUSH_BATCH_SIZE), MessageNotifier())
+    elif backend == "memory":
+        return (InMemoryServerDAO(), MessageNotifier())
+    else:
+        raise ValueError("Unknown storage backend " + backend)
+
+
+def load_session_secret():
+    if SESSION_SECRET:
+        return SESSION_SECRET.encode('utf-8')
+    os.makedirs(STORAGE_FOLDER, exist_ok=True)
+    path = os.path.join(STORAGE_FOLDER, SESSION_SECRET_FILE)
+    temp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w", encoding="utf-8") as secret_file:
+        secret_file.write(crypto.generate_session_secret().hex())
+        secret_file.flush()
+        os.fsync(secret_file.fileno())
+    try:
+        os.link(temp_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(temp_path)
+    with open(path, "r", encoding="utf-8") as secret_file:
+        return bytes.fromhex(secret_file.read())
+
+
+(dao, notifier) = create_storage(STORAGE_BACKEND)
+service = ServerServices(dao, notifier=notifier, session_secret=load_session_secret(),
+                         mailbox_max_messages=MAILBOX_MAX_MESSAGES, mailbox_max_bytes=MAILBOX_MAX_BYTES,
+                         message_ttl=timedelta(days=MESSAGE_TTL_DAYS))
+sweeper = MessageSweeper(service, SWEEP_INTERVAL)
+executor = ThreadPoolExecutor(max_workers=WORKER_THREADS)
+
+app = FastAPI(default_response_class=SerializedJSONResponse)
+app.add_middleware(metrics.MetricsMiddleware)
+
+
+def collect_public_key_cache_metrics():
+    stats = service.public_key_cache.stats()
+    return [("e2e_public_key_cache_size", "gauge", "Public keys held in the cache.", [({}, stats["size"])]),
+            ("e2e_public_key_cache_hits_total", "counter", "Public key cache hits.", [({}, stats["hits"])]),
+            ("e2e_public_key_cache_misses_total", "counter", "Public key cache misses.", [({}, stats["misses"])])]
+
+
+def collect_crypto_metrics():
+    timings = crypto.stage_timings()
+    return [("e2e_crypto_stage_seconds_total", "counter", "Time spent in crypto stages, when E2E_CRYPTO_TIMING=1.",
+             [({"stage": stage}, timing["seconds"]) for (stage, timing) in timings.items()]),
+            ("e2e_crypto_stage_calls_total", "counter", "Calls to crypto stages, when E2E_CRYPTO_TIMING=1.",
+             [({"stage": stage}, timing["count"]) for (stage, timing) in timings.items()])]
+
+
+metrics.registry.add_collector(collect_public_key_cache_metrics)
+metrics.registry.add_collector(collect_crypto_metrics)
+
+
+async def run_blocking(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+
+def encode_messages(messages):
+    return [base64.b64encode(message).decode('utf-8') if isinstance(message, bytes) else message for message in messages]
 
-app = FastAPI()
+
+async def read_pending_messages(username, cursor, limit):
+    if cursor is None and limit is None:
+        return {"messages": encode_messages(await run_blocking(service.read_messages, username))}
+    (messages, next_cursor) = await run_blocking(service.read_messages_page, username, cursor or 0,
+                                                 min(max(limit or MAX_PULL_LIMIT, 1), MAX_PULL_LIMIT))
+    return {"messages": encode_messages(messages), "cursor": next_cursor}
+
+
+@app.on_event("shutdown")
+def shutdown():
+    executor.shutdown()
+    sweeper.close()
+    notifier.close()
+    dao.close()
 
 
 @app.get("/v1/health")
@@ -33,40 +170,111 @@ async def root():
     return {"healthy": True}
 
 
+@app.get("/v1/metrics")
+async def get_metrics():
+    return Response(content=metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @app.put("/v1/user/register", status_code=204)
 async def register_user(register_info: RegisterInfo, response: Response):
-    created = service.register_user(username=register_info.username,
-                                    public_key=register_info.public_key, time=register_info.time)
+    created = await run_blocking(service.register_user, register_info.username,
+                                 register_info.public_key, register_info.time)
     if created:
-        return
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
     else:
         response.status_code = status.HTTP_409_CONFLICT
         return {"status": "There is already a user with that username"}
 
 
+@app.post("/v1/user/{username}/session")
+async def create_session(username: str, auth: AuthInfo, response: Response):
+    session = await run_blocking(service.create_session, auth) if username == auth.username else None
+    if session is not None:
+        return session
+    else:
+        response.status_code = status.HTTP_401_UNAUTHORIZED
+        return {"status": "Invalid auth"}
+
+
 @app.get("/v1/user/{username}")
 async def get_user_info(username: str, response: Response):
-    user_info = service.get_user_info(username)
+    user_info = await run_blocking(service.get_user_info, username)
     if len(user_info['username']) == 0:
         response.status_code = status.HTTP_404_NOT_FOUND
-    return service.get_user_info(username)
+    return user_info
 
 
 @app.put("/v1/user/{username}/message/send", status_code=204)
 async def send_message_to_user(username: str, send_message_info: SendMessageInfo, response: Response):
-    if username == send_message_info.auth.username and service.authenticate_user(send_message_info.auth):
-        service.send_message_to_user(
-            send_message_info.recipient, send_message_info.message)
-        return
+    if username == send_message_info.auth.username and await run_blocking(service.authenticate_user, send_message_info.auth):
+        if await run_blocking(service.send_message_to_user, send_message_info.recipient, send_message_info.message):
+            return Response(status_code=status.HTTP_204_NO_CONTENT)
+        response.status_code = status.HTTP_507_INSUFFICIENT_STORAGE
+        return {"status": "Recipient mailbox is full"}
+    else:
+        response.status_code = status.HTTP_401_UNAUTHORIZED
+        return {"status": "Invalid auth"}
+
+
+@app.put("/v1/user/{username}/message/send-batch", status_code=204)
+async def send_messages_to_users(username: str, send_batch_message_info: SendBatchMessageInfo, response: Response):
+    if username == send_batch_message_info.auth.username and await run_blocking(service.authenticate_user, send_batch_message_info.auth):
+        rejected_recipients = await run_blocking(service.send_messages_to_users,
+                                                 [(message_info.recipient, message_info.message) for message_info in send_batch_message_info.messages])
+        if len(rejected_recipients) == 0:
+            return Response(status_code=status.HTTP_204_NO_CONTENT)
+        response.status_code = status.HTTP_507_INSUFFICIENT_STORAGE
+        return {"status": "Recipient mailbox is full", "recipients": rejected_recipients}
+    else:
+        response.status_code = status.HTTP_401_UNAUTHORIZED
+        return {"status": "Invalid auth"}
+
+
+@app.put("/v1/user/{username}/message/send-binary", status_code=204)
+async def send_binary_message_to_user(username: str, recipient: str, request: Request, response: Response,
+                                      x_auth_time: str = Header(""), x_auth_signature: str = Header(""), x_auth_token: str = Header("")):
+    auth = AuthInfo(username=username, time=x_auth_time, signature=x_auth_signature, token=x_auth_token)
+    if await run_blocking(service.authenticate_user, auth):
+        if await run_blocking(service.send_message_to_user, recipient, await request.body()):
+            return Response(status_code=status.HTTP_204_NO_CONTENT)
+        response.status_code = status.HTTP_507_INSUFFICIENT_STORAGE
+        return {"status": "Recipient mailbox is full"}
     else:
         response.status_code = status.HTTP_401_UNAUTHORIZED
         return {"status": "Invalid auth"}
 
 
 @app.post("/v1/user/{username}/message/pull")
-async def read_messages(username: str, auth: AuthInfo, response: Response):
-    if username == auth.username and service.authenticate_user(auth):
-        return {"messages": service.read_messages(username)}
+async def read_messages(username: str, auth: AuthInfo, response: Response, cursor: Optional[int] = None, limit: Optional[int] = None):
+    if username == auth.username and await run_blocking(service.authenticate_user, auth):
+        return await read_pending_messages(username, cursor, limit)
+    else:
+        response.status_code = status.HTTP_401_UNAUTHORIZED
+        return {"status": "Invalid auth"}
+
+
+@app.post("/v1/user/{username}/message/ack", status_code=204)
+async def ack_messages(username: str, ack_messages_info: AckMessagesInfo, response: Response):
+    if username == ack_messages_info.auth.username and await run_blocking(service.authenticate_user, ack_messages_info.auth):
+        await run_blocking(service.ack_messages, username, ack_messages_info.cursor)
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+    else:
+        response.status_code = status.HTTP_401_UNAUTHORIZED
+        return {"status": "Invalid auth"}
+
+
+@app.post("/v1/user/{username}/message/wait")
+async def wait_for_messages(username: str, auth: AuthInfo, response: Response, timeout: float = 30,
+                            cursor: Optional[int] = None, limit: Optional[int] = None):
+    if username == auth.username and await run_blocking(service.authenticate_user, auth):
+        waiter = service.notifier.subscribe(username)
+        try:
+            pending = await read_pending_messages(username, cursor, limit)
+            if len(pending["messages"]) == 0 and await service.notifier.wait(waiter, min(max(timeout, 0), MAX_WAIT_TIMEOUT)):
+                pending = await read_pending_messages(username, cursor, limit)
+        finally:
+            service.notifier.unsubscribe(username, waiter)
+        return pending
     else:
         response.status_code = status.HTTP_401_UNAUTHORIZED
         return {"status": "Invalid auth"}
@@ -1,32 +1,171 @@
-from datetime import datetime
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from ..crypto import crypto
+from .notifier import MessageNotifier
+from .metrics import timed_stage, mailbox_messages
+
+
+class PublicKeyCache():
+    MAX_SIZE = 10000
+
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username, public_key_contents):
+        with self.lock:
+            cached = self.keys.get(username)
+            if cached is not None and cached[0] == public_key_contents:
+                self.keys.move_to_end(username)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+        with timed_stage("auth_key_import"):
+            public_key = crypto.import_public_key(public_key_contents)
+        with self.lock:
+            self.keys[username] = (public_key_contents, public_key)
+            self.keys.move_to_end(username)
+            if len(self.keys) > self.max_size:
+                self.keys.popitem(last=False)
+        return public_key
+
+    def invalidate(self, username):
+        with self.lock:
+            self.keys.pop(username, None)
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.keys), "hits": self.hits, "misses": self.misses}
 
 
 class ServerServices():
-    def __init__(self, dao):
+    SESSION_LIFETIME = timedelta(minutes=15)
+
+    def __init__(self, dao, public_key_cache=None, notifier=None, session_secret=None,
+                 mailbox_max_messages=None, mailbox_max_bytes=None, message_ttl=None):
         self.dao = dao
+        self.mailbox_max_messages = mailbox_max_messages
+        self.mailbox_max_bytes = mailbox_max_bytes
+        self.message_ttl = message_ttl
+        self.session_secret = session_secret if session_secret is not None else crypto.generate_session_secret()
+        self.public_key_cache = public_key_cache if public_key_cache is not None else PublicKeyCache()
+        self.notifier = notifier if notifier is not None else MessageNotifier()
 
     def register_user(self, username, public_key, time):
-        return self.dao.create_user(username, public_key, time)
+        with self.dao.lock_for(username):
+            created = self.dao.create_user(username, public_key, time)
+        if created:
+            self.public_key_cache.invalidate(username)
+        return created
 
     def get_user_info(self, username):
         user_info = self.dao.get_user_info(username)
         return {"username": user_info["username"], "public_key": user_info["public_key"]}
 
     def authenticate_user(self, auth):
-        request_time = datetime.fromisoformat(auth.time)
-        user_info = self.dao.get_user_info(auth.username)
-        if auth.username == user_info['username'] and request_time > user_info['last_date_time'] and crypto.verify_auth_signature(
-                crypto.import_public_key(user_info['public_key']), auth.signature, auth.username, request_time):
-            self.dao.update_user_auth_time(auth.username, request_time)
-            return True
-        else:
+        if auth.token:
+            with timed_stage("auth_session_verify"):
+                return crypto.verify_session_token(self.session_secret, auth.token, auth.username, crypto.current_date_time())
+        return self.__authenticate_signature(auth)
+
+    def create_session(self, auth):
+        if auth.token or not self.__authenticate_signature(auth):
+            return None
+        expires = crypto.current_date_time() + self.SESSION_LIFETIME
+        return {"token": crypto.generate_session_token(self.session_secret, auth.username, expires), "expires": expires.isoformat()}
+
+    def __authenticate_signature(self, auth):
+        if len(auth.time) == 0 or len(auth.signature) == 0:
+            return False
+        try:
+            request_time = datetime.fromisoformat(auth.time)
+        except ValueError:
             return False
+        with timed_stage("auth_user_lookup"):
+            user_info = self.dao.get_user_info(auth.username)
+        try:
+            if auth.username != user_info['username'] or request_time <= user_info['last_date_time']:
+                return False
+        except TypeError:
+            return False
+        public_key = self.public_key_cache.get(auth.username, user_info['public_key'])
+        with timed_stage("auth_signature_verify"):
+            verified = crypto.verify_auth_signature(public_key, auth.signature, auth.username, request_time)
+        if not verified:
+            return False
+        with self.dao.lock_for(auth.username):
+            return self.dao.advance_user_auth_time(auth.username, request_time)
 
     def send_message_to_user(self, recipient, message):
-        self.dao.save_user_message(recipient, message)
+        with self.dao.lock_for(recipient):
+            usage = self.dao.get_user_mailbox_usage(recipient)
+            mailbox_messages.observe(usage[0])
+            if not self.__fits_in_mailbox(usage, message):
+                return False
+            self.dao.save_user_message(recipient, message)
+        self.notifier.notify(recipient)
+        return True
+
+    def send_messages_to_users(self, messages):
+        locked_messages = {}
+        for (recipient, message) in messages:
+            lock = self.dao.lock_for(recipient)
+            locked_messages.setdefault(id(lock), (lock, []))[1].append((recipient, message))
+        rejected_recipients = set()
+        accepted_recipients = set()
+        for (lock, messages_for_lock) in locked_messages.values():
+            with lock:
+                accepted = self.__filter_full_mailboxes(messages_for_lock, rejected_recipients)
+                self.dao.save_user_messages(accepted)
+            accepted_recipients.update(recipient for (recipient, _) in accepted)
+        for recipient in accepted_recipients:
+            self.notifier.notify(recipient)
+        return sorted(rejected_recipients)
+
+    def __filter_full_mailboxes(self, messages, rejected_recipients):
+        usages = {}
+        accepted = []
+        for (recipient, message) in messages:
+            if recipient not in usages:
+                usages[recipient] = self.dao.get_user_mailbox_usage(recipient)
+                mailbox_messages.observe(usages[recipient][0])
+            if self.__fits_in_mailbox(usages[recipient], message):
+                usages[recipient] = (usages[recipient][0] + 1, usages[recipient][1] + len(message))
+                accepted.append((recipient, message))
+            else:
+                rejected_recipients.add(recipient)
+        return accepted
+
+    def __fits_in_mailbox(self, usage, message):
+        (message_count, message_bytes) = usage
+        if self.mailbox_max_messages is not None and message_count + 1 > self.mailbox_max_messages:
+            return False
+        if self.mailbox_max_bytes is not None and message_bytes + len(message) > self.mailbox_max_bytes:
+            return False
+        return True
+
+    def expire_messages(self):
+        if self.message_ttl is None:
+            return 0
+        return self.dao.expire_pending_messages(time.time() - self.message_ttl.total_seconds())
 
     def read_messages(self, username):
-        messages = self.dao.get_user_pending_messages(username)
-        self.dao.clear_user_pending_messages(username=username)
+        with self.dao.lock_for(username):
+            (messages, cursor) = self.dao.get_user_pending_messages_page(username, 0, None)
+            self.dao.ack_user_pending_messages(username, cursor)
         return messages
+
+    def read_messages_page(self, username, cursor, limit):
+        with self.dao.lock_for(username):
+            self.dao.ack_user_pending_messages(username, cursor)
+            return self.dao.get_user_pending_messages_page(username, cursor, limit)
+
+    def ack_messages(self, username, cursor):
+        with self.dao.lock_for(username):
+            self.dao.ack_user_pending_messages(username, cursor)
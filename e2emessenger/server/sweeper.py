@@ -0,0 +1,30 @@
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class MessageSweeper():
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, service, sweep_interval=SWEEP_INTERVAL):
+        self.service = service
+        self.sweep_interval = sweep_interval
+        self.stopped = threading.Event()
+        self.sweeper = threading.Thread(target=self.__sweep, daemon=True)
+        self.sweeper.start()
+
+    def __sweep(self):
+        while not self.stopped.wait(self.sweep_interval):
+            try:
+                expired = self.service.expire_messages()
+            except Exception:
+                logger.warning("Sweeping expired messages failed", exc_info=True)
+                continue
+            if expired > 0:
+                logger.info("Expired %d messages", expired)
+
+    def close(self):
+        self.stopped.set()
+        self.sweeper.join()
@@ -1,8 +1,38 @@
+import os
+import json
 import time
+import base64
+import asyncio
+import shutil
+import sqlite3
+import tempfile
 import unittest
-from datetime import datetime
+import threading
+import io
+import contextlib
+import httpx
+import requests
+from datetime import datetime, timedelta
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from types import SimpleNamespace
+from unittest import mock
+from fastapi.testclient import TestClient
 from cryptography.hazmat.primitives.asymmetric import rsa
 from ..crypto import crypto
+from ..client.dao import FileBasedClientDAO
+from ..client.service import PeerKeyCache, TimeoutHTTPAdapter, ClientServices
+from ..client.async_service import AsyncClientServices
+from ..serialization import serialization
+from ..server.dao import encode_binary_message, decode_stored_message, read_stored_users, InMemoryServerDAO, FileBasedServerDAO, LogBasedServerDAO, SqliteServerDAO, ShardedServerDAO
+from ..server.service import PublicKeyCache, ServerServices
+from ..server.notifier import MessageNotifier, PollingMessageNotifier
+from ..server.metrics import MetricsRegistry
+
+
+def import_server():
+    with mock.patch.dict(os.environ, {"E2E_SERVER_STORAGE": "memory", "E2E_SESSION_SECRET": "secret", "E2E_SERVER_WORKERS": "1"}):
+        from ..server import server
+    return server
 
 
 class TestCryptoMethods(unittest.TestCase):
@@ -86,6 +116,21 @@ class TestCryptoMethods(unittest.TestCase):
                                                       signature=s,
                                                       username=username,
                                                       date_time=date_time))
+        self.assertFalse(crypto.verify_auth_signature(public_key=private_key.public_key(),
+                                                      signature='not base64!',
+                                                      username=username,
+                                                      date_time=date_time))
+
+    def test_generate_and_check_session_token(self):
+        secret = crypto.generate_session_secret()
+        now = crypto.current_date_time()
+        token = crypto.generate_session_token(secret, 'Joshua', now + timedelta(minutes=1))
+        self.assertTrue(crypto.verify_session_token(secret, token, 'Joshua', now))
+        self.assertFalse(crypto.verify_session_token(secret, token, 'Josh', now))
+        self.assertFalse(crypto.verify_session_token(secret, token, 'Joshua', now + timedelta(minutes=2)))
+        self.assertFalse(crypto.verify_session_token(crypto.generate_session_secret(), token, 'Joshua', now))
+        self.assertFalse(crypto.verify_session_token(secret, token[:-4], 'Joshua', now))
+        self.assertFalse(crypto.verify_session_token(secret, 'not a token', 'Joshua', now))
 
     def test_encrypt_and_decrypt(self):
         sender_private_key = crypto.generate_keypair()
@@ -124,3 +169,966 @@ class TestCryptoMethods(unittest.TestCase):
             len(different_sender_private_key_decrypted["hash"]), 0)
         self.assertEqual(
             len(different_sender_private_key_decrypted["signature"]), 0)
+
+    def test_decrypt_then_verify(self):
+        sender_private_key = crypto.generate_keypair()
+        receiver_private_key = crypto.generate_keypair()
+        ciphertext = crypto.encrypt_message(
+            sender_private_key, receiver_private_key.public_key(), 'Joshua', 'Vince', crypto.current_date_time(), 'Hello world!')
+        contents = crypto.decrypt_message_contents(receiver_private_key, ciphertext)
+        self.assertEqual('Hello world!', contents["message"])
+        missing_peer = crypto.verify_message_contents(contents, {})
+        self.assertEqual('Joshua', missing_peer["from"])
+        self.assertEqual(0, len(missing_peer["to"]))
+        verified = crypto.verify_message_contents(contents, {'Joshua': sender_private_key.public_key()})
+        self.assertEqual('Vince', verified["to"])
+
+    def test_stage_timings(self):
+        private_key = crypto.generate_keypair()
+        crypto.reset_stage_timings()
+        crypto.STAGE_TIMING = True
+        try:
+            ciphertext = crypto.encrypt_message(
+                private_key, private_key.public_key(), 'Joshua', 'Joshua', crypto.current_date_time(), 'Hello world!')
+            crypto.decrypt_message(private_key, {'Joshua': private_key.public_key()}, ciphertext)
+        finally:
+            crypto.STAGE_TIMING = False
+        timings = crypto.stage_timings()
+        for stage in ['sign', 'encrypt', 'decrypt', 'verify']:
+            self.assertEqual(1, timings[stage]["count"])
+        crypto.reset_stage_timings()
+        self.assertEqual({}, crypto.stage_timings())
+
+    def test_decrypt_legacy_format(self):
+        sender_private_key = crypto.generate_keypair()
+        receiver_private_key = crypto.generate_keypair()
+        time = crypto.current_date_time()
+        message = 'Hello world! ' * 100
+        crypto.MESSAGE_FORMAT = crypto.LEGACY_MESSAGE_FORMAT
+        try:
+            legacy_ciphertext = crypto.encrypt_message(
+                sender_private_key, receiver_private_key.public_key(), 'Joshua', 'Vince', time, message)
+        finally:
+            crypto.MESSAGE_FORMAT = crypto.HYBRID_MESSAGE_FORMAT
+        ciphertext = crypto.encrypt_message(
+            sender_private_key, receiver_private_key.public_key(), 'Joshua', 'Vince', time, message)
+        self.assertIn('|', legacy_ciphertext)
+        self.assertLess(len(ciphertext) * 2, len(legacy_ciphertext))
+        envelope = crypto.encrypt_message_bytes(
+            sender_private_key, receiver_private_key.public_key(), 'Joshua', 'Vince', time, message)
+        self.assertIsInstance(envelope, bytes)
+        self.assertEqual(envelope[0], crypto.HYBRID_MESSAGE_FORMAT)
+        self.assertLess(len(envelope), len(ciphertext))
+        for to_decrypt in [legacy_ciphertext, ciphertext, envelope]:
+            decrypted = crypto.decrypt_message(
+                receiver_private_key, {'Joshua': sender_private_key.public_key()}, to_decrypt)
+            self.assertEqual(message, decrypted["message"])
+            self.assertEqual('Vince', decrypted["to"])
+
+
+class TestFileBasedServerDAO(unittest.TestCase):
+    def setUp(self):
+        self.storage_folder = os.path.join(tempfile.mkdtemp(), 'server_data')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.storage_folder))
+
+    def load_stored_users(self):
+        with open(os.path.join(self.storage_folder, FileBasedServerDAO.STORAGE_FILE), 'rb') as storage_file:
+            return read_stored_users(storage_file)
+
+    def test_synchronous_writes(self):
+        dao = FileBasedServerDAO(self.storage_folder)
+        dao.create_user('Joshua', 'key', crypto.current_date_time().isoformat())
+        dao.save_user_message('Joshua', b'\x02first')
+        self.assertEqual(len(self.load_stored_users()['Joshua']['messages']), 1)
+        self.assertEqual(os.listdir(self.storage_folder), [FileBasedServerDAO.STORAGE_FILE])
+        dao.close()
+
+    def test_write_behind_coalesces_and_flushes_on_close(self):
+        dao = FileBasedServerDAO(self.storage_folder, flush_interval=60, flush_batch_size=1000)
+        dao.create_user('Joshua', 'key', crypto.current_date_time().isoformat())
+        dao.save_user_messages([('Joshua', 'first'), ('Joshua', b'\x02second')])
+        dao.save_user_message('Joshua', 'third')
+        self.assertFalse(os.path.exists(os.path.join(self.storage_folder, FileBasedServerDAO.STORAGE_FILE)))
+        dao.close()
+
+        reloaded = FileBasedServerDAO(self.storage_folder)
+        self.assertEqual(reloaded.get_user_pending_messages('Joshua'), ['first', b'\x02second', 'third'])
+        reloaded.close()
+
+    def test_load_without_rewriting(self):
+        dao = FileBasedServerDAO(self.storage_folder)
+        dao.create_user('Joshua', 'key', crypto.current_date_time().isoformat())
+        dao.create_user('Vince', 'key', crypto.current_date_time().isoformat())
+        dao.save_user_messages([('Joshua', 'first'), ('Vince', b'\x02second')])
+        dao.close()
+        modified_time = os.stat(os.path.join(self.storage_folder, FileBasedServerDAO.STORAGE_FILE)).st_mtime_ns
+
+        reloaded = FileBasedServerDAO(self.storage_folder)
+        self.assertEqual(reloaded.get_user_pending_messages('Joshua'), ['first'])
+        self.assertEqual(reloaded.get_user_pending_messages('Vince'), [b'\x02second'])
+        self.assertEqual(reloaded.get_user_mailbox_usage('Vince'), (1, 7))
+        reloaded.close()
+        self.assertEqual(os.stat(os.path.join(self.storage_folder, FileBasedServerDAO.STORAGE_FILE)).st_mtime_ns, modified_time)
+
+    def test_load_legacy_format(self):
+        os.makedirs(self.storage_folder)
+        with open(os.path.join(self.storage_folder, FileBasedServerDAO.STORAGE_FILE), 'w', encoding='utf-8') as storage_file:
+            storage_file.write(json.dumps({'Joshua': {'username': 'Joshua', 'public_key': 'key', 'messages': ['first', {'binary': 'Ag=='}],
+                                                      'last_date_time': crypto.current_date_time().isoformat()}}))
+        dao = FileBasedServerDAO(self.storage_folder)
+        self.assertEqual(dao.get_user_pending_messages('Joshua'), ['first', b'\x02'])
+        dao.save_user_message('Joshua', 'third')
+        dao.close()
+        self.assertEqual(self.load_stored_users()['Joshua']['messages'], ['first', b'\x02', 'third'])
+
+    def test_failed_load_is_not_overwritten(self):
+        os.makedirs(self.storage_folder)
+        with open(os.path.join(self.storage_folder, FileBasedServerDAO.STORAGE_FILE), 'w', encoding='utf-8') as storage_file:
+            storage_file.write('{"username": "Joshua", "mess')
+        with self.assertLogs('e2emessenger.server.dao', 'ERROR'):
+            dao = FileBasedServerDAO(self.storage_folder)
+            dao.loaded.wait()
+        with self.assertRaises(RuntimeError):
+            dao.save_user_message('Joshua', 'lost')
+        dao.close()
+        with open(os.path.join(self.storage_folder, FileBasedServerDAO.STORAGE_FILE), 'r', encoding='utf-8') as storage_file:
+            self.assertEqual(storage_file.read(), '{"username": "Joshua", "mess')
+
+    def test_write_behind_flushes_after_batch_size(self):
+        dao = FileBasedServerDAO(self.storage_folder, flush_interval=60, flush_batch_size=3)
+        dao.create_user('Joshua', 'key', crypto.current_date_time().isoformat())
+        dao.save_user_message('Joshua', 'first')
+        dao.save_user_message('Joshua', 'second')
+        deadline = time.time() + 5
+        while not os.path.exists(os.path.join(self.storage_folder, FileBasedServerDAO.STORAGE_FILE)) and time.time() < deadline:
+            time.sleep(.01)
+        self.assertEqual(self.load_stored_users()['Joshua']['messages'], ['first', 'second'])
+        dao.close()
+
+
+class TestLogBasedServerDAO(unittest.TestCase):
+    def setUp(self):
+        self.storage_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_folder)
+
+    def test_replay_log(self):
+        dao = LogBasedServerDAO(self.storage_folder)
+        auth_time = crypto.current_date_time()
+        self.assertTrue(dao.create_user('Joshua', 'key', auth_time.isoformat()))
+        self.assertFalse(dao.create_user('Joshua', 'other', auth_time.isoformat()))
+        dao.create_user('Vince', 'key', auth_time.isoformat())
+        dao.save_user_message('Joshua', 'first')
+        dao.save_user_message('Joshua', b'\x02second')
+        dao.save_user_message('Vince', 'third')
+        dao.clear_user_pending_messages('Vince')
+        dao.update_user_auth_time('Joshua', auth_time)
+        dao.save_user_messages([('Joshua', 'fourth'), ('Nobody', 'lost'), ('Vince', b'\x02fifth')])
+        dao.close()
+
+        reloaded = LogBasedServerDAO(self.storage_folder)
+        self.assertEqual(reloaded.get_user_pending_messages('Joshua'), ['first', b'\x02second', 'fourth'])
+        self.assertEqual(reloaded.get_user_pending_messages('Vince'), [b'\x02fifth'])
+        self.assertEqual(reloaded.get_user_info('Joshua')['last_date_time'], auth_time)
+        reloaded.close()
+
+    def test_pagination(self):
+        dao = LogBasedServerDAO(self.storage_folder)
+        dao.create_user('Joshua', 'key', crypto.current_date_time().isoformat())
+        dao.save_user_messages([('Joshua', str(i)) for i in range(5)])
+        (first_page, cursor) = dao.get_user_pending_messages_page('Joshua', 0, 2)
+        self.assertEqual(first_page, ['0', '1'])
+        self.assertEqual(dao.ack_user_pending_messages('Joshua', cursor), 2)
+        self.assertEqual(dao.get_user_pending_messages_page('Joshua', 0, 2)[0], ['2', '3'])
+        dao.close()
+
+        reloaded = LogBasedServerDAO(self.storage_folder)
+        (second_page, cursor) = reloaded.get_user_pending_messages_page('Joshua', cursor, 10)
+        self.assertEqual(second_page, ['2', '3', '4'])
+        reloaded.ack_user_pending_messages('Joshua', cursor)
+        self.assertEqual(reloaded.get_user_pending_messages_page('Joshua', cursor, 10), ([], cursor))
+        reloaded.save_user_message('Joshua', '5')
+        self.assertEqual(reloaded.get_user_pending_messages_page('Joshua', cursor, 10)[0], ['5'])
+        reloaded.close()
+
+    def test_compaction(self):
+        dao = LogBasedServerDAO(self.storage_folder, compaction_threshold=3)
+        dao.create_user('Joshua', 'key', crypto.current_date_time().isoformat())
+        for i in range(5):
+            dao.save_user_message('Joshua', str(i))
+        self.assertEqual(dao.log_entries, 0)
+        dao.close()
+
+        reloaded = LogBasedServerDAO(self.storage_folder, compaction_threshold=3)
+        self.assertEqual(reloaded.get_user_pending_messages('Joshua'), ['0', '1', '2', '3', '4'])
+        self.assertEqual(len([name for name in os.listdir(self.storage_folder) if name.startswith('server_log.')]), 1)
+        reloaded.close()
+
+    def test_binary_messages_stored_raw(self):
+        dao = LogBasedServerDAO(self.storage_folder)
+        dao.create_user('Joshua', 'key', crypto.current_date_time().isoformat())
+        log_size = os.path.getsize(os.path.join(self.storage_folder, 'server_log.0'))
+        message = os.urandom(3000)
+        dao.save_user_messages([('Joshua', message), ('Joshua', b'\n\x02')])
+        valid_size = os.path.getsize(os.path.join(self.storage_folder, 'server_log.0'))
+        self.assertLess(valid_size - log_size, len(base64.b64encode(message)))
+        dao.close()
+        with open(os.path.join(self.storage_folder, 'server_log.0'), 'ab') as log_file:
+            log_file.write(b'{"op":"save_user_message","recipient":"Joshua","message":{"binary_length":10},"sent_time":1}\nshort')
+
+        reloaded = LogBasedServerDAO(self.storage_folder)
+        self.assertEqual(reloaded.get_user_pending_messages('Joshua'), [message, b'\n\x02'])
+        self.assertEqual(os.path.getsize(os.path.join(self.storage_folder, 'server_log.0')), valid_size)
+        reloaded.compact()
+        reloaded.close()
+        reloaded = LogBasedServerDAO(self.storage_folder)
+        self.assertEqual(reloaded.get_user_pending_messages('Joshua'), [message, b'\n\x02'])
+        reloaded.close()
+
+    def test_load_single_object_snapshot(self):
+        os.makedirs(self.storage_folder, exist_ok=True)
+        with open(os.path.join(self.storage_folder, LogBasedServerDAO.SNAPSHOT_FILE), 'w', encoding='utf-8') as snapshot_file:
+            snapshot_file.write(json.dumps({'generation': 2, 'users': {'Joshua': {
+                'username': 'Joshua', 'public_key': 'key', 'messages': ['first', {'binary': 'Ag=='}], 'message_offset': 1,
+                'last_date_time': crypto.current_date_time().isoformat()}}}))
+        dao = LogBasedServerDAO(self.storage_folder)
+        self.assertEqual(dao.get_user_pending_messages_page('Joshua', 0, None), (['first', b'\x02'], 3))
+        dao.compact()
+        dao.close()
+
+        with open(os.path.join(self.storage_folder, LogBasedServerDAO.SNAPSHOT_FILE), 'rb') as snapshot_file:
+            self.assertEqual(json.loads(snapshot_file.readline()), {'generation': 3})
+        reloaded = LogBasedServerDAO(self.storage_folder)
+        self.assertEqual(reloaded.get_user_pending_messages_page('Joshua', 0, None), (['first', b'\x02'], 3))
+        reloaded.close()
+
+    def test_expiry_survives_restart(self):
+        dao = LogBasedServerDAO(self.storage_folder)
+        dao.create_user('Joshua', 'key', crypto.current_date_time().isoformat())
+        dao.save_user_message('Joshua', 'old')
+        expire_before = time.time() + 1
+        dao.save_user_message('Joshua', 'first')
+        dao.in_memory.users['Joshua']['message_times'][1] = expire_before + 1
+        self.assertEqual(dao.expire_pending_messages(expire_before), 1)
+        self.assertEqual(dao.log_entries, 4)
+        dao.save_user_message('Joshua', b'\x02second')
+        dao.close()
+
+        reloaded = LogBasedServerDAO(self.storage_folder)
+        self.assertEqual(reloaded.get_user_pending_messages_page('Joshua', 0, None), (['first', b'\x02second'], 3))
+        self.assertEqual(reloaded.get_user_mailbox_usage('Joshua'), (2, 12))
+        reloaded.close()
+
+    def test_torn_log_tail(self):
+        dao = LogBasedServerDAO(self.storage_folder)
+        dao.create_user('Joshua', 'key', crypto.current_date_time().isoformat())
+        dao.save_user_message('Joshua', 'first')
+        dao.close()
+        with open(os.path.join(self.storage_folder, 'server_log.0'), 'ab') as log_file:
+            log_file.write(b'{"op": "save_user_mes')
+
+        reloaded = LogBasedServerDAO(self.storage_folder)
+        reloaded.save_user_message('Joshua', 'second')
+        reloaded.close()
+
+        recovered = LogBasedServerDAO(self.storage_folder)
+        self.assertEqual(recovered.get_user_pending_messages('Joshua'), ['first', 'second'])
+        recovered.close()
+
+
+class TestSqliteServerDAO(unittest.TestCase):
+    def setUp(self):
+        self.storage_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_folder)
+
+    def test_users_and_messages(self):
+        dao = SqliteServerDAO(self.storage_folder)
+        auth_time = crypto.current_date_time()
+        self.assertTrue(dao.create_user('Joshua', 'key', auth_time.isoformat()))
+        self.assertFalse(dao.create_user('Joshua', 'other', auth_time.isoformat()))
+        dao.create_user('Vince', 'key', auth_time.isoformat())
+        dao.save_user_message('Joshua', b'\x02first')
+        dao.save_user_message('Vince', 'second')
+        dao.save_user_message('Joshua', 'third')
+        dao.save_user_message('Nobody', 'lost')
+        dao.clear_user_pending_messages('Vince')
+        dao.update_user_auth_time('Joshua', auth_time)
+        dao.save_user_messages([('Vince', 'fourth'), ('Nobody', 'lost'), ('Vince', 'fifth')])
+        dao.close()
+
+        reopened = SqliteServerDAO(self.storage_folder)
+        user_info = reopened.get_user_info('Joshua')
+        self.assertEqual(user_info['public_key'], 'key')
+        self.assertEqual(user_info['last_date_time'], auth_time)
+        self.assertEqual(user_info['messages'], [])
+        self.assertEqual(reopened.get_user_pending_messages('Joshua'), [b'\x02first', 'third'])
+        self.assertEqual(reopened.get_user_pending_messages('Vince'), ['fourth', 'fifth'])
+        self.assertEqual(reopened.get_user_info('Nobody')['username'], '')
+        reopened.close()
+
+    def test_pagination(self):
+        dao = SqliteServerDAO(self.storage_folder)
+        dao.create_user('Joshua', 'key', crypto.current_date_time().isoformat())
+        dao.create_user('Vince', 'key', crypto.current_date_time().isoformat())
+        dao.save_user_messages([(recipient, str(i)) for i in range(3) for recipient in ['Joshua', 'Vince']])
+        (first_page, cursor) = dao.get_user_pending_messages_page('Joshua', 0, 2)
+        self.assertEqual(first_page, ['0', '1'])
+        self.assertEqual(dao.ack_user_pending_messages('Joshua', cursor), 2)
+        (second_page, cursor) = dao.get_user_pending_messages_page('Joshua', cursor, 2)
+        self.assertEqual(second_page, ['2'])
+        dao.ack_user_pending_messages('Joshua', cursor)
+        self.assertEqual(dao.get_user_pending_messages_page('Joshua', cursor, 2), ([], cursor))
+        self.assertEqual(dao.get_user_pending_messages('Vince'), ['0', '1', '2'])
+        dao.close()
+
+    def test_migrate_and_expire(self):
+        connection = sqlite3.connect(os.path.join(self.storage_folder, SqliteServerDAO.DATABASE_FILE))
+        connection.execute("CREATE TABLE users (username TEXT PRIMARY KEY, public_key TEXT NOT NULL, last_date_time TEXT NOT NULL)")
+        connection.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, recipient TEXT NOT NULL, message BLOB NOT NULL)")
+        connection.execute("INSERT INTO users VALUES ('Joshua', 'key', ?)", (crypto.current_date_time().isoformat(),))
+        connection.execute("INSERT INTO messages (recipient, message) VALUES ('Joshua', 'old')")
+        connection.commit()
+        connection.close()
+
+        dao = SqliteServerDAO(self.storage_folder)
+        expire_before = time.time() + 1
+        dao.save_user_message('Joshua', b'\x02new')
+        self.assertEqual(dao.get_user_mailbox_usage('Joshua'), (2, 7))
+        self.assertEqual(dao.expire_pending_messages(expire_before), 2)
+        self.assertEqual(dao.get_user_mailbox_usage('Joshua'), (0, 0))
+        dao.close()
+
+    def test_shared_between_connections(self):
+        first = SqliteServerDAO(self.storage_folder)
+        second = SqliteServerDAO(self.storage_folder)
+        auth_time = crypto.current_date_time()
+        first.create_user('Joshua', 'key', auth_time.isoformat())
+        self.assertFalse(second.create_user('Joshua', 'other', auth_time.isoformat()))
+        self.assertTrue(first.advance_user_auth_time('Joshua', auth_time + timedelta(seconds=1)))
+        self.assertFalse(second.advance_user_auth_time('Joshua', auth_time + timedelta(seconds=1)))
+        self.assertTrue(second.advance_user_auth_time('Joshua', auth_time + timedelta(seconds=2)))
+
+        last_message_id = first.get_last_message_id()
+        second.save_user_messages([('Joshua', 'first'), ('Joshua', 'second'), ('Nobody', 'lost')])
+        (recipients, last_message_id) = first.get_message_recipients_since(last_message_id)
+        self.assertEqual(recipients, ['Joshua'])
+        self.assertEqual(first.get_message_recipients_since(last_message_id), ([], last_message_id))
+        self.assertEqual(first.get_user_pending_messages('Joshua'), ['first', 'second'])
+        first.close()
+        second.close()
+
+
+class TestShardedServerDAO(unittest.TestCase):
+    def setUp(self):
+        self.storage_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_folder)
+
+    def test_users_spread_over_shards(self):
+        dao = ShardedServerDAO(self.storage_folder, shard_count=4)
+        usernames = ['user' + str(i) for i in range(20)]
+        for username in usernames:
+            self.assertTrue(dao.create_user(username, 'key', crypto.current_date_time().isoformat()))
+        dao.save_user_messages([(username, 'hello ' + username) for username in usernames] + [('Nobody', 'lost')])
+        self.assertGreater(len(set(id(dao.lock_for(username)) for username in usernames)), 1)
+        dao.close()
+
+        reloaded = ShardedServerDAO(self.storage_folder, shard_count=8)
+        self.assertEqual(4, reloaded.shard_count)
+        for username in usernames:
+            self.assertEqual(['hello ' + username], reloaded.get_user_pending_messages(username))
+        reloaded.close()
+
+    def test_import_unsharded_storage(self):
+        unsharded = LogBasedServerDAO(self.storage_folder)
+        unsharded.create_user('Joshua', 'key', crypto.current_date_time().isoformat())
+        unsharded.create_user('Vince', 'key', crypto.current_date_time().isoformat())
+        unsharded.save_user_messages([('Joshua', 'first'), ('Vince', b'\x02second')])
+        unsharded.close()
+
+        dao = ShardedServerDAO(self.storage_folder, shard_count=4)
+        self.assertEqual(['first'], dao.get_user_pending_messages('Joshua'))
+        self.assertEqual([b'\x02second'], dao.get_user_pending_messages('Vince'))
+        self.assertFalse(any(file_name.startswith(LogBasedServerDAO.LOG_FILE_PREFIX) for file_name in os.listdir(self.storage_folder)))
+        dao.close()
+
+    def test_concurrent_sends(self):
+        dao = ShardedServerDAO(self.storage_folder, shard_count=4)
+        services = ServerServices(dao)
+        usernames = ['user' + str(i) for i in range(8)]
+        for username in usernames:
+            services.register_user(username, 'key', crypto.current_date_time().isoformat())
+
+        def send(username):
+            for i in range(50):
+                services.send_message_to_user(username, str(i))
+
+        threads = [threading.Thread(target=send, args=(username,)) for username in usernames * 2]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for username in usernames:
+            self.assertEqual(100, len(services.read_messages(username)))
+        dao.close()
+
+
+class TestServerServices(unittest.TestCase):
+    def generate_auth(self, private_key, username):
+        date_time = crypto.current_date_time()
+        return SimpleNamespace(username=username, time=date_time.isoformat(), token='',
+                               signature=crypto.generate_auth_signature(private_key, username, date_time))
+
+    def test_authenticate_user_caches_public_key(self):
+        service = ServerServices(InMemoryServerDAO())
+        private_key = crypto.generate_keypair()
+        service.register_user('Joshua', crypto.export_public_key(private_key.public_key()),
+                              datetime.min.isoformat())
+        self.assertTrue(service.authenticate_user(self.generate_auth(private_key, 'Joshua')))
+        self.assertTrue(service.authenticate_user(self.generate_auth(private_key, 'Joshua')))
+        self.assertEqual(service.public_key_cache.stats(), {"size": 1, "hits": 1, "misses": 1})
+
+        replayed_auth = self.generate_auth(private_key, 'Joshua')
+        self.assertTrue(service.authenticate_user(replayed_auth))
+        self.assertFalse(service.authenticate_user(replayed_auth))
+        self.assertFalse(service.authenticate_user(self.generate_auth(crypto.generate_keypair(), 'Joshua')))
+
+    def test_session_authentication(self):
+        service = ServerServices(InMemoryServerDAO())
+        private_key = crypto.generate_keypair()
+        service.register_user('Joshua', crypto.export_public_key(private_key.public_key()),
+                              datetime.min.isoformat())
+        session = service.create_session(self.generate_auth(private_key, 'Joshua'))
+        token_auth = SimpleNamespace(username='Joshua', time='', signature='', token=session['token'])
+        self.assertTrue(service.authenticate_user(token_auth))
+        self.assertTrue(service.authenticate_user(token_auth))
+        self.assertIsNone(service.create_session(token_auth))
+        self.assertFalse(service.authenticate_user(SimpleNamespace(
+            username='Vince', time='', signature='', token=session['token'])))
+        self.assertIsNone(service.create_session(self.generate_auth(crypto.generate_keypair(), 'Joshua')))
+
+    def test_public_key_cache_eviction(self):
+        cache = PublicKeyCache(max_size=1)
+        first_key = crypto.export_public_key(crypto.generate_keypair().public_key())
+        second_key = crypto.export_public_key(crypto.generate_keypair().public_key())
+        cache.get('Joshua', first_key)
+        cache.get('Vince', second_key)
+        cache.get('Joshua', first_key)
+        self.assertEqual(cache.stats(), {"size": 1, "hits": 0, "misses": 3})
+        self.assertEqual(crypto.export_public_key(cache.get('Joshua', second_key)), second_key)
+
+    def test_mailbox_quotas(self):
+        service = ServerServices(InMemoryServerDAO(), mailbox_max_messages=2, mailbox_max_bytes=10)
+        service.register_user('Joshua', 'key', datetime.min.isoformat())
+        service.register_user('Vince', 'key', datetime.min.isoformat())
+        self.assertTrue(service.send_message_to_user('Joshua', 'first'))
+        self.assertFalse(service.send_message_to_user('Joshua', 'too long'))
+        self.assertTrue(service.send_message_to_user('Joshua', 'two'))
+        self.assertFalse(service.send_message_to_user('Joshua', 'x'))
+        with mock.patch.object(service.notifier, 'notify') as notify:
+            self.assertEqual(service.send_messages_to_users([('Vince', 'a'), ('Joshua', 'b'), ('Vince', 'c'), ('Vince', 'd')]),
+                             ['Joshua', 'Vince'])
+        notify.assert_called_once_with('Vince')
+        self.assertEqual(service.read_messages('Vince'), ['a', 'c'])
+        self.assertEqual(service.read_messages('Joshua'), ['first', 'two'])
+        self.assertTrue(service.send_message_to_user('Joshua', 'third'))
+
+    def test_message_expiry(self):
+        service = ServerServices(InMemoryServerDAO(), message_ttl=timedelta(seconds=.05))
+        service.register_user('Joshua', 'key', datetime.min.isoformat())
+        service.send_message_to_user('Joshua', 'old')
+        time.sleep(.1)
+        service.send_message_to_user('Joshua', 'new')
+        self.assertEqual(service.expire_messages(), 1)
+        self.assertEqual(service.read_messages_page('Joshua', 0, 10), (['new'], 2))
+        self.assertEqual(service.dao.get_user_mailbox_usage('Joshua'), (1, 3))
+
+    def test_message_expiry_concurrent_with_sends(self):
+        storage_folder = tempfile.mkdtemp()
+        try:
+            for dao in [InMemoryServerDAO(), LogBasedServerDAO(storage_folder, compaction_threshold=100)]:
+                service = ServerServices(dao, message_ttl=timedelta(0))
+                service.register_user('Joshua', 'key', datetime.min.isoformat())
+                sent = 2000
+                errors = []
+
+                def send_messages():
+                    try:
+                        for i in range(sent):
+                            service.send_message_to_user('Joshua', str(i))
+                    except Exception as e:
+                        errors.append(e)
+
+                sender = threading.Thread(target=send_messages)
+                sender.start()
+                expired = 0
+                while sender.is_alive():
+                    expired += service.expire_messages()
+                sender.join()
+                self.assertEqual(errors, [])
+                pending = dao.get_user_pending_messages('Joshua')
+                self.assertEqual(expired + len(pending), sent)
+                self.assertEqual(pending, [str(i) for i in range(expired, sent)])
+                dao.close()
+                if isinstance(dao, LogBasedServerDAO):
+                    reloaded = LogBasedServerDAO(storage_folder)
+                    self.assertEqual(reloaded.get_user_pending_messages('Joshua'), pending)
+                    reloaded.close()
+        finally:
+            shutil.rmtree(storage_folder)
+
+
+class TestMessageNotifier(unittest.TestCase):
+    def test_notify_from_other_thread(self):
+        async def wait_for_notification():
+            notifier = MessageNotifier()
+            waiter = notifier.subscribe('Joshua')
+            threading.Timer(.05, notifier.notify, args=('Joshua',)).start()
+            notified = await notifier.wait(waiter, 5)
+            notifier.unsubscribe('Joshua', waiter)
+            return (notified, notifier.waiters)
+
+        self.assertEqual(asyncio.run(wait_for_notification()), (True, {}))
+
+    def test_wait_timeout(self):
+        async def wait_for_notification():
+            notifier = MessageNotifier()
+            waiter = notifier.subscribe('Joshua')
+            notifier.notify('Vince')
+            notified = await notifier.wait(waiter, .05)
+            notifier.unsubscribe('Joshua', waiter)
+            return (notified, notifier.waiters)
+
+        self.assertEqual(asyncio.run(wait_for_notification()), (False, {}))
+
+    def test_polling_notifier_sees_other_connections(self):
+        storage_folder = tempfile.mkdtemp()
+        listening_dao = SqliteServerDAO(storage_folder)
+        sending_dao = SqliteServerDAO(storage_folder)
+        sending_dao.create_user('Joshua', 'key', crypto.current_date_time().isoformat())
+        notifier = PollingMessageNotifier(listening_dao, poll_interval=.01)
+
+        async def wait_for_notification():
+            waiter = notifier.subscribe('Joshua')
+            threading.Timer(.05, sending_dao.save_user_message, args=('Joshua', 'hello')).start()
+            notified = await notifier.wait(waiter, 5)
+            notifier.unsubscribe('Joshua', waiter)
+            return notified
+
+        try:
+            self.assertTrue(asyncio.run(wait_for_notification()))
+        finally:
+            notifier.close()
+            listening_dao.close()
+            sending_dao.close()
+            shutil.rmtree(storage_folder)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        registry = MetricsRegistry()
+        requests = registry.counter("requests_total", "Requests.", ("route",))
+        latency = registry.histogram("latency_seconds", "Latency.", ("route",), buckets=(.1, 1))
+        registry.add_collector(lambda: [("cache_size", "gauge", "Cache size.", [({}, 3)])])
+        requests.inc('/v1/user/"quoted"')
+        requests.inc('/v1/user/"quoted"', amount=2)
+        latency.observe(.05, '/v1/health')
+        latency.observe(.5, '/v1/health')
+        latency.observe(5, '/v1/health')
+        lines = registry.render().splitlines()
+        self.assertIn('requests_total{route="/v1/user/\\"quoted\\""} 3.0', lines)
+        self.assertIn('latency_seconds_bucket{route="/v1/health",le="0.1"} 1.0', lines)
+        self.assertIn('latency_seconds_bucket{route="/v1/health",le="1.0"} 2.0', lines)
+        self.assertIn('latency_seconds_bucket{route="/v1/health",le="+Inf"} 3.0', lines)
+        self.assertIn('latency_seconds_sum{route="/v1/health"} 5.55', lines)
+        self.assertIn('latency_seconds_count{route="/v1/health"} 3.0', lines)
+        self.assertIn('# TYPE cache_size gauge', lines)
+        self.assertIn('cache_size 3.0', lines)
+
+
+class TestSerialization(unittest.TestCase):
+    def test_backends_round_trip(self):
+        value = {"username": "user\u00e9", "messages": [b"\x00\xff", "text"], "message_offset": 2, "message_times": [1.5]}
+        for backend in serialization.available_backends():
+            serializer = serialization.create_serializer(backend)
+            contents = serializer.dumps_bytes(value, default=encode_binary_message)
+            loaded = serializer.loads(contents)
+            self.assertEqual([decode_stored_message(message) for message in loaded["messages"]], [b"\x00\xff", "text"])
+            self.assertEqual(loaded["username"], "user\u00e9")
+            self.assertEqual(serializer.loads(serializer.dumps(loaded)), loaded)
+            self.assertEqual(json.loads(contents), loaded)
+
+    def test_unavailable_backend(self):
+        with self.assertRaises(ValueError):
+            serialization.create_serializer("missing")
+
+
+class TestServerEndpoints(unittest.TestCase):
+    def setUp(self):
+        self.server = import_server()
+        self.original_service = self.server.service
+        self.storage_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.service = self.original_service
+        shutil.rmtree(self.storage_folder)
+
+    def for_each_backend(self, test):
+        for dao in [InMemoryServerDAO(), SqliteServerDAO(self.storage_folder)]:
+            with self.subTest(dao=type(dao).__name__):
+                self.server.service = ServerServices(dao, session_secret=b'secret')
+                client = TestClient(self.server.app)
+                self.keypair = crypto.generate_keypair()
+                test(client, self.register(client, 'Joshua', self.keypair), self.register(client, 'Vince', self.keypair))
+            dao.close()
+
+    def register(self, client, username, keypair):
+        client.put('/v1/user/register', json={
+            'username': username, 'public_key': crypto.export_public_key(keypair.public_key()), 'time': crypto.current_date_time().isoformat()})
+        date_time = crypto.current_date_time()
+        r = client.post('/v1/user/' + username + '/session', json={
+            'username': username, 'time': date_time.isoformat(), 'signature': crypto.generate_auth_signature(keypair, username, date_time)})
+        return {'username': username, 'token': r.json()['token']}
+
+    def send(self, client, auth, recipient, message):
+        return client.put('/v1/user/' + auth['username'] + '/message/send',
+                          json={'auth': auth, 'recipient': recipient, 'message': message})
+
+    def pull(self, client, auth, **params):
+        return client.post('/v1/user/' + auth['username'] + '/message/pull', params=params, json=auth)
+
+    def mailbox_size(self, username):
+        return self.server.service.dao.get_user_mailbox_usage(username)[0]
+
+    def test_pull_pages_and_ack(self):
+        def test(client, joshua, vince):
+            for i in range(5):
+                self.assertEqual(self.send(client, joshua, 'Vince', str(i)).status_code, 204)
+            self.send(client, joshua, 'Joshua', 'self')
+
+            first_page = self.pull(client, vince, cursor=0, limit=2).json()
+            self.assertEqual(first_page['messages'], ['0', '1'])
+            self.assertEqual(self.pull(client, vince, cursor=0, limit=2).json(), first_page)
+            self.assertEqual(self.mailbox_size('Vince'), 5)
+
+            second_page = self.pull(client, vince, cursor=first_page['cursor'], limit=2).json()
+            self.assertEqual(second_page['messages'], ['2', '3'])
+            self.assertEqual(self.mailbox_size('Vince'), 3)
+            last_page = self.pull(client, vince, cursor=second_page['cursor'], limit=2).json()
+            self.assertEqual(last_page['messages'], ['4'])
+            self.assertEqual(self.mailbox_size('Vince'), 1)
+
+            ack = {'auth': vince, 'cursor': last_page['cursor']}
+            self.assertEqual(client.post('/v1/user/Joshua/message/ack', json=ack).status_code, 401)
+            self.assertEqual(client.post('/v1/user/Vince/message/ack', json=ack).status_code, 204)
+            self.assertEqual(self.mailbox_size('Vince'), 0)
+            self.assertEqual(self.pull(client, vince, cursor=last_page['cursor'], limit=2).json(),
+                             {'messages': [], 'cursor': last_page['cursor']})
+
+            self.send(client, joshua, 'Vince', 'unpaged')
+            self.assertEqual(self.pull(client, vince).json(), {'messages': ['unpaged']})
+            self.assertEqual(self.pull(client, vince).json(), {'messages': []})
+            self.assertEqual(self.pull(client, joshua).json(), {'messages': ['self']})
+            self.assertEqual(self.pull(client, {'username': 'Vince', 'token': joshua['token']}).status_code, 401)
+        self.for_each_backend(test)
+
+    def test_send_binary(self):
+        def test(client, joshua, vince):
+            message = os.urandom(300)
+            date_time = crypto.current_date_time()
+            signed_headers = {'X-Auth-Time': date_time.isoformat(),
+                              'X-Auth-Signature': crypto.generate_auth_signature(self.keypair, 'Joshua', date_time)}
+            r = client.put('/v1/user/Joshua/message/send-binary', params={'recipient': 'Vince'}, data=message, headers=signed_headers)
+            self.assertEqual(r.status_code, 204)
+            r = client.put('/v1/user/Joshua/message/send-binary', params={'recipient': 'Vince'}, data=message, headers=signed_headers)
+            self.assertEqual(r.status_code, 401)
+            r = client.put('/v1/user/Joshua/message/send-binary', params={'recipient': 'Vince'}, data=b'\x02second',
+                           headers={'X-Auth-Token': joshua['token']})
+            self.assertEqual(r.status_code, 204)
+            r = client.put('/v1/user/Joshua/message/send-binary', params={'recipient': 'Vince'}, data=b'lost',
+                           headers={'X-Auth-Token': vince['token']})
+            self.assertEqual(r.status_code, 401)
+            for auth_time in ['bad', crypto.current_date_time().astimezone().isoformat()]:
+                r = client.put('/v1/user/Joshua/message/send-binary', params={'recipient': 'Vince'}, data=b'lost',
+                               headers={'X-Auth-Time': auth_time, 'X-Auth-Signature': signed_headers['X-Auth-Signature']})
+                self.assertEqual(r.status_code, 401)
+                signed_auth = {'username': 'Vince', 'time': auth_time, 'signature': signed_headers['X-Auth-Signature']}
+                self.assertEqual(client.post('/v1/user/Vince/session', json=signed_auth).status_code, 401)
+                self.assertEqual(self.pull(client, signed_auth).status_code, 401)
+            self.assertEqual([base64.b64decode(message) for message in self.pull(client, vince).json()['messages']], [message, b'\x02second'])
+        self.for_each_backend(test)
+
+    def test_wait_returns_pending_page(self):
+        def test(client, joshua, vince):
+            r = client.post('/v1/user/Vince/message/wait', params={'timeout': .05, 'cursor': 0, 'limit': 2}, json=vince)
+            self.assertEqual(r.json(), {'messages': [], 'cursor': 0})
+            for i in range(3):
+                self.send(client, joshua, 'Vince', str(i))
+            r = client.post('/v1/user/Vince/message/wait', params={'timeout': 5, 'cursor': 0, 'limit': 2}, json=vince)
+            self.assertEqual(r.json()['messages'], ['0', '1'])
+            self.assertEqual(self.mailbox_size('Vince'), 3)
+            r = client.post('/v1/user/Vince/message/wait', params={'timeout': 5, 'cursor': r.json()['cursor'], 'limit': 2}, json=vince)
+            self.assertEqual(r.json()['messages'], ['2'])
+            self.assertEqual(self.mailbox_size('Vince'), 1)
+            self.assertEqual(client.post('/v1/user/Vince/message/wait', params={'timeout': .05}, json=joshua).status_code, 401)
+        self.for_each_backend(test)
+
+
+class TestAsyncClientServices(unittest.TestCase):
+    def setUp(self):
+        self.server = import_server()
+        self.original_service = self.server.service
+        self.server.service = ServerServices(InMemoryServerDAO(), session_secret=b'secret')
+
+    def tearDown(self):
+        self.server.service = self.original_service
+
+    def run_with_clients(self, test, *usernames):
+        async def run():
+            async with httpx.AsyncClient(app=self.server.app, base_url='http://test') as http_client:
+                clients = [AsyncClientServices('http://test', username, crypto.generate_keypair(), http_client=http_client)
+                           for username in usernames]
+                for client in clients:
+                    self.assertTrue(await client.register())
+                await test(*clients)
+        asyncio.run(run())
+
+    def test_send_and_pull(self):
+        async def test(joshua, vince, zach):
+            self.assertTrue(await joshua.send_message('Vince', 'first'))
+            self.assertTrue(await joshua.send_messages(['Vince', 'Zach'], 'second'))
+            self.assertFalse(await joshua.send_message('Nobody', 'lost'))
+            messages = await vince.pull_messages()
+            self.assertEqual([(message['from'], message['message']) for message in messages], [('Joshua', 'first'), ('Joshua', 'second')])
+            self.assertEqual([message['message'] for message in await zach.pull_messages()], ['second'])
+            self.assertEqual(await vince.pull_messages(), [])
+        self.run_with_clients(test, 'Joshua', 'Vince', 'Zach')
+
+    def test_pull_several_pages(self):
+        async def test(joshua, vince):
+            vince.PULL_PAGE_SIZE = 2
+            for i in range(5):
+                self.assertTrue(await joshua.send_message('Vince', str(i)))
+            self.assertEqual([message['message'] for message in await vince.pull_messages()], ['0', '1', '2', '3', '4'])
+            self.assertEqual(self.server.service.dao.get_user_mailbox_usage('Vince'), (0, 0))
+        self.run_with_clients(test, 'Joshua', 'Vince')
+
+    def test_wait_for_messages(self):
+        async def test(joshua, vince):
+            waiting = asyncio.ensure_future(vince.wait_for_messages(timeout=5))
+            await asyncio.sleep(.1)
+            self.assertFalse(waiting.done())
+            self.assertTrue(await joshua.send_message('Vince', 'first'))
+            self.assertEqual([message['message'] for message in await waiting], ['first'])
+            self.assertEqual(await vince.wait_for_messages(timeout=.1), [])
+        self.run_with_clients(test, 'Joshua', 'Vince')
+
+    def test_invalid_session_is_dropped(self):
+        async def test(joshua, vince):
+            self.assertTrue(await joshua.send_message('Vince', 'first'))
+            joshua.session_token = 'Joshua.invalid'
+            self.assertFalse(await joshua.send_message('Vince', 'lost'))
+            self.assertIsNone(joshua.session_token)
+            self.assertTrue(await joshua.send_message('Vince', 'second'))
+            self.assertEqual([message['message'] for message in await vince.pull_messages()], ['first', 'second'])
+        self.run_with_clients(test, 'Joshua', 'Vince')
+
+    def test_concurrent_requests_share_a_session(self):
+        async def test(joshua, vince):
+            results = await asyncio.gather(*[joshua.send_message('Vince', str(i)) for i in range(10)])
+            self.assertEqual(results, [True] * 10)
+            self.assertEqual(len(await vince.pull_messages()), 10)
+        self.run_with_clients(test, 'Joshua', 'Vince')
+
+
+class StubClientDAO():
+    def __init__(self):
+        self.peers = {}
+        self.conversations = {}
+
+    def save_peer(self, username, public_key):
+        self.peers[username] = public_key
+
+    def load_peer(self, username):
+        return self.peers.get(username)
+
+    def list_peers(self):
+        return list(self.peers)
+
+    def append_conversation_messages(self, peer, messages):
+        self.conversations.setdefault(peer, []).extend(messages)
+
+
+class StubClientServices(ClientServices):
+    def __init__(self, dao, keypair):
+        self.keypair = keypair
+        super().__init__(dao)
+
+    def initialize(self):
+        return ('http://test', 'Vince', self.keypair)
+
+
+class TestClientServices(unittest.TestCase):
+    def test_input_and_verify_messages(self):
+        keypairs = {username: crypto.generate_keypair() for username in ['Joshua', 'Vince', 'Zach', 'Nobody']}
+        dao = StubClientDAO()
+        dao.save_peer('Joshua', keypairs['Joshua'].public_key())
+        service = StubClientServices(dao, keypairs['Vince'])
+
+        def encrypt(sender, message):
+            return crypto.encrypt_message(keypairs[sender], keypairs['Vince'].public_key(), sender, 'Vince', crypto.current_date_time(), message)
+
+        messages = [encrypt('Joshua', 'first'), 'not a message', encrypt('Zach', 'second'), encrypt('Nobody', 'lost'),
+                    encrypt('Joshua', 'third'), encrypt('Joshua', 'fourth')[:-8] + 'AAAAAAAA']
+        lookups = []
+
+        def find_user_public_key(to_search):
+            lookups.append(to_search)
+            return crypto.export_public_key(keypairs['Zach'].public_key()) if to_search == 'Zach' else ''
+
+        with mock.patch.object(service, '_ClientServices__find_user_public_key', find_user_public_key), \
+                contextlib.redirect_stdout(io.StringIO()):
+            service._ClientServices__input_and_verify_messages(messages)
+        service.close()
+
+        self.assertEqual(sorted(lookups), ['Nobody', 'Zach'])
+        self.assertEqual([message['message'] for message in dao.conversations['Joshua']], ['first', 'third'])
+        self.assertEqual([message['message'] for message in dao.conversations['Zach']], ['second'])
+        self.assertEqual(sorted(dao.conversations), ['Joshua', 'Zach'])
+        self.assertIn('Zach', dao.peers)
+        self.assertEqual(set(service.last_pull_timings), {'decrypt', 'peer_lookup', 'verify', 'save'})
+
+    def test_hostile_sender_names(self):
+        base_dir = tempfile.mkdtemp()
+        try:
+            dao = FileBasedClientDAO(os.path.join(base_dir, 'client_data'))
+            with open(os.path.join(base_dir, 'client_data', 'key.private'), 'w', encoding='utf-8') as key_file:
+                key_file.write('not a public key')
+            keypairs = {username: crypto.generate_keypair() for username in ['Joshua', 'Vince']}
+            dao.save_peer('Joshua', keypairs['Joshua'].public_key())
+            service = StubClientServices(dao, keypairs['Vince'])
+            messages = [crypto.encrypt_message(keypairs['Joshua'], keypairs['Vince'].public_key(), sender, 'Vince',
+                                               crypto.current_date_time(), 'hi')
+                        for sender in ['', '.', '..', '../key.private', 'peers/Joshua', 'Joshua']]
+            lookups = []
+
+            def find_user_public_key(to_search):
+                lookups.append(to_search)
+                return crypto.export_public_key(keypairs['Joshua'].public_key())
+
+            with mock.patch.object(service, '_ClientServices__find_user_public_key', find_user_public_key), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                service._ClientServices__input_and_verify_messages(messages)
+            service.close()
+
+            self.assertEqual(sorted(lookups), ['.', '..', '../key.private', 'peers/Joshua'])
+            self.assertEqual(dao.list_peers(), ['Joshua'])
+            self.assertEqual([message['message'] for message in dao.load_conversation('Joshua')], ['hi'])
+            self.assertEqual(sorted(os.listdir(os.path.join(base_dir, 'client_data', 'conversations'))), ['Joshua'])
+        finally:
+            shutil.rmtree(base_dir)
+
+
+class UnavailableHandler(BaseHTTPRequestHandler):
+    def respond_unavailable(self):
+        self.server.methods.append(self.command)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(503)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = do_POST = do_PUT = respond_unavailable
+
+    def log_message(self, *args):
+        pass
+
+
+class TestClientHttpSession(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), UnavailableHandler)
+        self.server.methods = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.server_url = 'http://127.0.0.1:' + str(self.server.server_address[1])
+        with mock.patch.object(StubClientServices, 'RETRY_BACKOFF', 0):
+            self.service = StubClientServices(StubClientDAO(), None)
+
+    def tearDown(self):
+        self.service.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_default_timeout(self):
+        with mock.patch.object(requests.adapters.HTTPAdapter, 'send', autospec=True, side_effect=requests.adapters.HTTPAdapter.send) as send:
+            self.service.http_session.post(self.server_url + '/v1/user/Vince/message/pull', json={})
+            self.service.http_session.post(self.server_url + '/v1/user/Vince/message/pull', json={}, timeout=3)
+        self.assertIsInstance(send.call_args_list[0].args[0], TimeoutHTTPAdapter)
+        self.assertEqual([call.kwargs['timeout'] for call in send.call_args_list], [ClientServices.REQUEST_TIMEOUT, 3])
+
+    def test_only_get_is_retried(self):
+        self.assertEqual(self.service.http_session.post(self.server_url + '/v1/user/Vince/message/pull', json={}).status_code, 503)
+        self.assertEqual(self.service.http_session.put(self.server_url + '/v1/user/Vince/message/send', json={}).status_code, 503)
+        self.assertEqual(self.server.methods, ['POST', 'PUT'])
+        self.assertRaises(requests.exceptions.RetryError, self.service.http_session.get, self.server_url + '/v1/user/Vince')
+        self.assertEqual(self.server.methods, ['POST', 'PUT'] + ['GET'] * (ClientServices.REQUEST_RETRIES + 1))
+
+
+class TestFileBasedClientDAO(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.dao = FileBasedClientDAO(os.path.join(self.base_dir, 'client_data'))
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def test_append_and_load_conversation(self):
+        first = {"sent": True, "time": crypto.current_date_time().isoformat(), "message": "Hello"}
+        second = {"sent": False, "time": crypto.current_date_time().isoformat(), "message": "Hi\nthere"}
+        self.assertEqual(self.dao.load_conversation('Vince'), [])
+        self.dao.append_conversation_messages('Vince', [first])
+        self.dao.append_conversation_messages('Vince', [second])
+        self.assertEqual(self.dao.load_conversation('Vince'), [first, second])
+        self.assertEqual(self.dao.load_conversation('Joshua'), [])
+
+    def test_conversation_with_unicode_line_separators(self):
+        messages = [{"sent": False, "time": crypto.current_date_time().isoformat(), "message": "a" + separator + "b"}
+                    for separator in ["\u2028", "\u2029", "\u0085", "\r", "\x1c"]]
+        self.dao.append_conversation_messages('Vince', messages[:2])
+        self.dao.append_conversation_messages('Vince', messages[2:])
+        self.assertEqual(self.dao.load_conversation('Vince'), messages)
+
+    def test_upgrade_legacy_conversation(self):
+        first = {"sent": True, "time": crypto.current_date_time().isoformat(), "message": "Hello"}
+        second = {"sent": False, "time": crypto.current_date_time().isoformat(), "message": "Hi"}
+        with open(os.path.join(self.base_dir, 'client_data', 'conversations', 'Vince'), 'w', encoding='utf-8') as conversation_file:
+            conversation_file.write(json.dumps([first]))
+        self.assertEqual(self.dao.load_conversation('Vince'), [first])
+        self.dao.append_conversation_messages('Vince', [second])
+        self.assertEqual(self.dao.load_conversation('Vince'), [first, second])
+
+    def test_save_and_load_peer(self):
+        public_key = crypto.generate_keypair().public_key()
+        self.assertIsNone(self.dao.load_peer('Vince'))
+        self.dao.save_peer('Vince', public_key)
+        self.assertEqual(crypto.export_public_key(self.dao.load_peer('Vince')), crypto.export_public_key(public_key))
+        self.assertEqual(self.dao.list_peers(), ['Vince'])
+        for username in ['', '.', '..', '../key.private', 'peers/Vince']:
+            self.assertIsNone(self.dao.load_peer(username))
+            self.assertRaises(ValueError, self.dao.save_peer, username, public_key)
+
+    def test_peer_key_cache(self):
+        public_key = crypto.generate_keypair().public_key()
+        self.dao.save_peer('Vince', public_key)
+        peers = PeerKeyCache(self.dao)
+        self.assertEqual(peers.public_keys, {})
+        self.assertIn('Vince', peers)
+        self.assertNotIn('Joshua', peers)
+        self.assertEqual(list(peers.public_keys), ['Vince'])
+        peers.add('Joshua', public_key)
+        self.assertEqual(sorted(peers), ['Joshua', 'Vince'])
+        self.assertEqual(crypto.export_public_key(self.dao.load_peer('Joshua')), crypto.export_public_key(public_key))